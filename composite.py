@@ -1,58 +1,467 @@
 # Composite is a structural design pattern which allows you to group objects into a tree structure, and then work
 # with them as if it were single object.
+from array import array
+from collections import namedtuple
+from operator import attrgetter
+
+# A leaf met during a traversal: the leaf itself, its depth below the root of the traversal, the indices of the
+# children leading to it (None unless asked for) and the offset to add to its coordinates to get the effective ones.
+LeafVisit = namedtuple('LeafVisit', 'graphic depth path dx dy')
+
+
+# Bounding boxes are (left, top, right, bottom) tuples; None is the box of an empty group.
+def _union(box, other):
+    if box is None:
+        return other
+    if other is None:
+        return box
+    return min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+
+
+def _shift(box, dx, dy):
+    if box is None:
+        return None
+    return box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy
+
+
+def _intersects(box, left, top, right, bottom):
+    return box is not None and box[0] <= right and left <= box[2] and box[1] <= bottom and top <= box[3]
+
 
 # Common Component interface.
 class Graphic:
+    # The group the graphic belongs to.
+    parent = None
+    # Whether the graphic has changed since it was last drawn. A new graphic has never been drawn.
+    _dirty = True
+
     def move(self, x, y):
         raise NotImplementedError("Method is not implemented!")
 
     def draw(self):
         raise NotImplementedError("Method is not implemented!")
 
+    # Draws only what has changed since the previous drawing.
+    def draw_dirty(self):
+        self._draw_dirty_at(*self._parent_offset())
+
+    # Draws the graphic with its coordinates shifted by (dx, dy).
+    def _draw_at(self, dx, dy):
+        raise NotImplementedError("Method is not implemented!")
+
+    def _draw_dirty_at(self, dx, dy):
+        raise NotImplementedError("Method is not implemented!")
+
+    # The box around the graphic, in the coordinates of its group.
+    def get_bounding_box(self):
+        raise NotImplementedError("Method is not implemented!")
+
+    # Leaves under the point (x, y), given in the coordinates of the group of the graphic.
+    def hit_test(self, x, y):
+        raise NotImplementedError("Method is not implemented!")
+
+    # Leaves whose bounding boxes intersect the rectangle, given in the coordinates of the group of the graphic.
+    def query(self, left, top, right, bottom):
+        raise NotImplementedError("Method is not implemented!")
+
+    # The pending offset that the groups of the graphic apply to it.
+    def _parent_offset(self):
+        if self.parent is None:
+            return 0, 0
+        return self.parent.get_offset()
 
-# Simple Component.
+    # Marks the graphic changed and tells the groups above which of their children lead to it. A group that already
+    # knows about the child has been told by the groups above it too, so the walk stops there.
+    def _mark_dirty(self):
+        self._dirty = True
+        graphic, group = self, self.parent
+        while group is not None and graphic not in group._dirty_children:
+            group._dirty_children[graphic] = None
+            graphic, group = group, group.parent
+
+    # The cached boxes of all groups above the graphic no longer fit after it has changed. A group with an invalid box
+    # only has groups with invalid boxes above it, so the walk stops at the first one.
+    def _invalidate_bounds(self):
+        group = self.parent
+        while group is not None and group._bounds_valid:
+            group._bounds_valid = False
+            group = group.parent
+
+
+# Simple Component. Its x and y are relative to the group it belongs to; get_position() returns the effective ones.
+# Setting them works like move(): the cached boxes of the groups above are invalidated and the dot is marked changed.
 class Dot(Graphic):
     def __init__(self, x, y):
-        self.x = x
-        self.y = y
+        self._x = x
+        self._y = y
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, x):
+        self._x = x
+        self._changed()
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, y):
+        self._y = y
+        self._changed()
 
     def move(self, x, y):
-        self.x += x
-        self.y += y
+        self._x += x
+        self._y += y
+        self._changed()
+
+    def get_bounding_box(self):
+        return self._x, self._y, self._x, self._y
+
+    def contains(self, x, y):
+        return x == self._x and y == self._y
+
+    def hit_test(self, x, y):
+        return [self] if self.contains(x, y) else []
+
+    def query(self, left, top, right, bottom):
+        return [self] if _intersects(self.get_bounding_box(), left, top, right, bottom) else []
+
+    def get_position(self):
+        dx, dy = self._parent_offset()
+        return self._x + dx, self._y + dy
 
     def draw(self):
-        print(f'Drawn dot with coordinates x = {self.x}, y = {self.y}')
+        self._draw_at(*self._parent_offset())
+
+    def _draw_at(self, dx, dy):
+        self._dirty = False
+        print(f'Drawn dot with coordinates x = {self._x + dx}, y = {self._y + dy}')
+
+    def _draw_dirty_at(self, dx, dy):
+        if self._dirty:
+            self._draw_at(dx, dy)
+
+    def _changed(self):
+        self._invalidate_bounds()
+        self._mark_dirty()
 
 
 # Components can extend other Components.
 class Circle(Dot):
     def __init__(self, x, y, radius):
         super().__init__(x, y)
-        self.radius = radius
+        self._radius = radius
 
-    def draw(self):
-        print(f'Drawn circle with coordinates x = {self.x}, y = {self.y} and radius = {self.radius}')
+    @property
+    def radius(self):
+        return self._radius
+
+    @radius.setter
+    def radius(self, radius):
+        self._radius = radius
+        self._changed()
+
+    def get_bounding_box(self):
+        x, y, radius = self._x, self._y, self._radius
+        return x - radius, y - radius, x + radius, y + radius
+
+    def contains(self, x, y):
+        return (x - self._x) ** 2 + (y - self._y) ** 2 <= self._radius ** 2
+
+    def _draw_at(self, dx, dy):
+        self._dirty = False
+        print(f'Drawn circle with coordinates x = {self._x + dx}, y = {self._y + dy} and radius = {self._radius}')
 
 
 # Composite contains operations for adding/removing child components. It delegates all standard operations of the
-# component interface to each of the child components.
+# component interface to each of the child components. Moving is the exception: the group only accumulates a pending
+# offset in constant time, and the offset is applied to the children when they are drawn or asked for their position.
+# flatten() applies the pending offsets to the coordinates of the leaves for good.
+# Each group also caches the bounding box of its children. Adding a child grows the cached boxes up the tree, while
+# removing or moving invalidates them, and they are recomputed on demand. hit_test and query skip the groups whose
+# boxes miss the searched area, so a well-grouped scene is searched without visiting most of it.
+# Finally, a group remembers which of its children have changed since they were drawn, so draw_dirty() visits only the
+# changed parts of the scene. A moved group is redrawn as a whole.
 class CompoundGraphic(Graphic):
     def __init__(self):
         self.children = []
+        self.offset_x = 0
+        self.offset_y = 0
+        # The box around the children, before the pending offset of the group is applied.
+        self._bounds = None
+        self._bounds_valid = True
+        # The children that have changed themselves or have changed graphics inside, in the order of changes.
+        self._dirty_children = {}
 
+    # The added graphic keeps its effective position, so the pending offset of the group is subtracted from it. A
+    # graphic belonging to another group is taken out of it first; a group cannot be added inside itself.
     def add(self, graphic):
+        group = self
+        while group is not None:
+            if group is graphic:
+                raise ValueError('A group cannot be added to itself or to a group inside it')
+            group = group.parent
+        if graphic.parent is not None:
+            graphic.parent.remove(graphic)
+        dx, dy = self.get_offset()
+        graphic.move(-dx, -dy)
+        graphic.parent = self
         self.children.append(graphic)
+        graphic._mark_dirty()
+        box = graphic.get_bounding_box()
+        group = self
+        while group is not None and group._bounds_valid:
+            group._bounds = _union(group._bounds, box)
+            box = _shift(box, group.offset_x, group.offset_y)
+            group = group.parent
 
     def remove(self, graphic):
         self.children.remove(graphic)
+        self._dirty_children.pop(graphic, None)
+        self._bounds_valid = False
+        self._invalidate_bounds()
+        self._mark_dirty()
+        dx, dy = self.get_offset()
+        graphic.parent = None
+        graphic.move(dx, dy)
 
     def move(self, x, y):
-        for child in self.children:
-            child.move(x, y)
+        self.offset_x += x
+        self.offset_y += y
+        self._invalidate_bounds()
+        self._mark_dirty()
+
+    # Invalid boxes are recomputed bottom-up with an explicit stack: a group is computed once all the groups inside it
+    # are valid again.
+    def get_bounding_box(self):
+        stack = [] if self._bounds_valid else [self]
+        while stack:
+            group = stack[-1]
+            invalid = [child for child in group.children
+                       if isinstance(child, CompoundGraphic) and not child._bounds_valid]
+            if invalid:
+                stack.extend(invalid)
+                continue
+            group._bounds = None
+            for child in group.children:
+                group._bounds = _union(group._bounds, child.get_bounding_box())
+            group._bounds_valid = True
+            stack.pop()
+        return _shift(self._bounds, self.offset_x, self.offset_y)
+
+    def hit_test(self, x, y):
+        def enter(group, dx, dy):
+            return _intersects(group.get_bounding_box(), x - dx, y - dy, x - dx, y - dy)
+
+        return [visit.graphic for visit in traverse(self, enter) if visit.graphic.contains(x - visit.dx, y - visit.dy)]
+
+    def query(self, left, top, right, bottom):
+        def enter(group, dx, dy):
+            return _intersects(group.get_bounding_box(), left - dx, top - dy, right - dx, bottom - dy)
+
+        return [visit.graphic for visit in traverse(self, enter)
+                if _intersects(visit.graphic.get_bounding_box(), left - visit.dx, top - visit.dy,
+                               right - visit.dx, bottom - visit.dy)]
+
+    # Yields a LeafVisit for every leaf, with the offsets that give the effective coordinates.
+    def iter_leaves(self, with_path=False):
+        return traverse(self, with_path=with_path, dx=self._parent_offset()[0], dy=self._parent_offset()[1])
+
+    # The total pending offset applied to the children: the offset of this group and of all groups above it.
+    def get_offset(self):
+        dx, dy = 0, 0
+        group = self
+        while group is not None:
+            dx += group.offset_x
+            dy += group.offset_y
+            group = group.parent
+        return dx, dy
+
+    def flatten(self):
+        # The offset of a group is pushed into its children before the traversal descends into them.
+        def enter(group, dx, dy):
+            offset_x, offset_y = group.offset_x, group.offset_y
+            group.offset_x = group.offset_y = 0
+            for child in group.children:
+                child.move(offset_x, offset_y)
+            return True
+
+        for _ in traverse(self, enter):
+            pass
 
     def draw(self):
-        for child in self.children:
-            child.draw()
+        self._draw_at(*self._parent_offset())
+
+    def _draw_at(self, dx, dy):
+        def enter(group, dx, dy):
+            group._dirty = False
+            group._dirty_children = {}
+            return True
+
+        for visit in traverse(self, enter, dx=dx, dy=dy):
+            visit.graphic._draw_at(visit.dx, visit.dy)
+
+    def _draw_dirty_at(self, dx, dy):
+        def enter(group, dx, dy):
+            if group._dirty:
+                group._draw_at(dx, dy)
+                return False
+            return True
+
+        def dirty_children(group):
+            children, group._dirty_children = group._dirty_children, {}
+            return children
+
+        for visit in traverse(self, enter, dirty_children, dx=dx, dy=dy):
+            visit.graphic._draw_dirty_at(visit.dx, visit.dy)
+
+
+# The traversal engine. It walks the tree below graphic depth-first with an explicit stack instead of recursion, so
+# the depth of the tree is limited only by memory, and yields a LeafVisit for every leaf as soon as it is reached.
+# Before descending into a group, enter(group, dx, dy) is called with the offset of the group's parent and decides
+# whether to descend at all; children_of(group) picks the children to visit. Stop iterating to stop the walk.
+def traverse(graphic, enter=None, children_of=attrgetter('children'), with_path=False, dx=0, dy=0):
+    if not isinstance(graphic, CompoundGraphic):
+        yield LeafVisit(graphic, 0, () if with_path else None, dx, dy)
+        return
+    if enter is not None and not enter(graphic, dx, dy):
+        return
+    stack = [(enumerate(children_of(graphic)), dx + graphic.offset_x, dy + graphic.offset_y)]
+    # The index of the group at every level of the stack but the first one.
+    indices = []
+    while stack:
+        children, dx, dy = stack[-1]
+        index, child = next(children, (None, None))
+        if child is None:
+            stack.pop()
+            if indices:
+                indices.pop()
+        elif isinstance(child, CompoundGraphic):
+            if enter is None or enter(child, dx, dy):
+                stack.append((enumerate(children_of(child)), dx + child.offset_x, dy + child.offset_y))
+                indices.append(index)
+        else:
+            yield LeafVisit(child, len(stack), (*indices, index) if with_path else None, dx, dy)
+
+
+# Kinds of the rows of a compiled scene.
+KIND_GROUP = 0
+KIND_DOT = 1
+KIND_CIRCLE = 2
+
+
+# A scene compiled into struct-of-arrays form: one row per graphic, groups included, with the effective x and y, the
+# radius (0 for dots and groups), the kind and the row of the parent group (-1 for the root) in separate arrays.
+# Operations run over whole columns instead of calling methods of every object; rows=None means all rows, otherwise
+# rows is a sequence of row indices, e.g. the result of select(). The x and y of a group row are the offset of its
+# children. write_back() stores the results in the objects.
+class SceneArrays:
+    def __init__(self, root):
+        self.root = root
+        self.graphics = []
+        self.x = array('d')
+        self.y = array('d')
+        self.radius = array('d')
+        self.kind = array('b')
+        self.parent = array('i')
+
+    def __len__(self):
+        return len(self.graphics)
+
+    def translate(self, dx, dy, rows=None):
+        if rows is None:
+            self.x = array('d', map(float(dx).__add__, self.x))
+            self.y = array('d', map(float(dy).__add__, self.y))
+            return
+        x, y = self.x, self.y
+        for row in rows:
+            x[row] += dx
+            y[row] += dy
+
+    # Scales positions relative to the origin, and the radii along with them.
+    def scale(self, factor, origin_x=0, origin_y=0, rows=None):
+        factor = float(factor)
+        if rows is None:
+            self.x = array('d', [origin_x + (value - origin_x) * factor for value in self.x])
+            self.y = array('d', [origin_y + (value - origin_y) * factor for value in self.y])
+            self.radius = array('d', map(abs(factor).__mul__, self.radius))
+            return
+        x, y, radius = self.x, self.y, self.radius
+        for row in rows:
+            x[row] = origin_x + (x[row] - origin_x) * factor
+            y[row] = origin_y + (y[row] - origin_y) * factor
+            radius[row] *= abs(factor)
+
+    # The box around the leaves among the rows, or None if there are none.
+    def get_bounding_box(self, rows=None):
+        leaves = self.select(rows=rows)
+        if not leaves:
+            return None
+        x, y, radius = self.x, self.y, self.radius
+        return (min(x[row] - radius[row] for row in leaves), min(y[row] - radius[row] for row in leaves),
+                max(x[row] + radius[row] for row in leaves), max(y[row] + radius[row] for row in leaves))
+
+    # Rows of the leaves of the given kind whose boxes intersect the rectangle (left, top, right, bottom).
+    def select(self, kind=None, rect=None, rows=None):
+        candidates = range(len(self)) if rows is None else rows
+        kinds = self.kind
+        if kind is None:
+            selected = [row for row in candidates if kinds[row] != KIND_GROUP]
+        else:
+            selected = [row for row in candidates if kinds[row] == kind]
+        if rect is not None:
+            left, top, right, bottom = rect
+            x, y, radius = self.x, self.y, self.radius
+            selected = [row for row in selected
+                        if x[row] - radius[row] <= right and left <= x[row] + radius[row]
+                        and y[row] - radius[row] <= bottom and top <= y[row] + radius[row]]
+        return array('i', selected)
+
+    # Stores the coordinates and radii of the rows in the objects. The pending offsets of the groups are flattened
+    # first, so the stored coordinates are the effective ones.
+    def write_back(self):
+        if isinstance(self.root, CompoundGraphic):
+            self.root.flatten()
+        dx, dy = self.root._parent_offset()
+        for graphic, kind, x, y, radius in zip(self.graphics, self.kind, self.x, self.y, self.radius):
+            if kind == KIND_GROUP:
+                continue
+            if x - dx != graphic.x or y - dy != graphic.y:
+                graphic.move(x - dx - graphic.x, y - dy - graphic.y)
+            if kind == KIND_CIRCLE and radius != graphic.radius:
+                graphic.radius = radius
+
+
+# Compiles the scene below graphic into SceneArrays.
+def compile_scene(graphic):
+    scene = SceneArrays(graphic)
+    rows = {}
+
+    def add_row(item, kind, x, y, radius):
+        rows[item] = len(scene.graphics)
+        scene.graphics.append(item)
+        scene.kind.append(kind)
+        scene.x.append(x)
+        scene.y.append(y)
+        scene.radius.append(radius)
+        scene.parent.append(rows.get(item.parent, -1) if item is not graphic else -1)
+
+    def enter(group, dx, dy):
+        add_row(group, KIND_GROUP, dx + group.offset_x, dy + group.offset_y, 0)
+        return True
+
+    dx, dy = graphic._parent_offset()
+    for visit in traverse(graphic, enter, dx=dx, dy=dy):
+        leaf = visit.graphic
+        if isinstance(leaf, Circle):
+            add_row(leaf, KIND_CIRCLE, leaf.x + visit.dx, leaf.y + visit.dy, leaf.radius)
+        else:
+            add_row(leaf, KIND_DOT, leaf.x + visit.dx, leaf.y + visit.dy, 0)
+    return scene
 
 
 if __name__ == '__main__':
@@ -69,3 +478,47 @@ if __name__ == '__main__':
 
     # Drawing all Graphics at once.
     cg.draw()
+
+    # Moving a group takes constant time, however many shapes it holds.
+    cg.move(10, 10)
+    cg2.move(1, 1)
+    cg.draw()
+    print(cg2.children[0].get_position())
+
+    # Picking the shapes under the cursor and culling the ones outside the viewport.
+    print(cg.get_bounding_box())
+    for graphic in cg.hit_test(16, 20):
+        graphic.draw()
+    print(len(cg.query(0, 0, 15, 15)), 'graphics intersect the viewport (0, 0) - (15, 15)')
+
+    # Only the changed parts of the scene are redrawn.
+    print('Redrawing after moving a single dot:')
+    cg2.children[0].move(1, 1)
+    cg.draw_dirty()
+
+    # Walking the leaves with their depth and path, without recursion.
+    for visit in cg.iter_leaves(with_path=True):
+        print(type(visit.graphic).__name__, visit.depth, visit.path, visit.graphic.get_position())
+
+    # Even very deep trees can be moved, drawn and searched. The tree is built from the bottom up, so adding a group
+    # does not have to walk all the groups above it.
+    deep = CompoundGraphic()
+    deep.add(Dot(3, 4))
+    for _ in range(50_000):
+        outer = CompoundGraphic()
+        outer.add(deep)
+        deep = outer
+    deep.move(1, 1)
+    deep.draw()
+    print(next(deep.iter_leaves()).depth, len(deep.hit_test(4, 5)), deep.get_bounding_box())
+
+    # Bulk geometry over the compiled columns: the scene is doubled around (10, 10), and the result is written back.
+    scene = compile_scene(cg)
+    scene.scale(2, 10, 10)
+    print(scene.get_bounding_box(), list(scene.select(kind=KIND_CIRCLE)), list(scene.parent))
+    scene.write_back()
+    cg.draw()
+
+    # Writing the effective coordinates into the shapes.
+    cg.flatten()
+    print(cg2.children[0].x, cg2.children[0].y)
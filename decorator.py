@@ -1,25 +1,221 @@
 # Decorator is a structural design pattern that allows you to dynamically add new functionality to objects by
 # wrapping them in useful wrappers.
+import bisect
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Common Component interface.
+CHUNK_SIZE = 64 * 1024
+# Longest key compile_chain builds by merging the keys of adjacent EncryptionDecorators.
+MAX_FUSED_KEY = 1024 * 1024
+
+
+def _to_bytes(data):
+    return data.encode() if isinstance(data, str) else data
+
+
+# XORs the block that starts at the given position of the data with the repeating key and returns the result in pieces
+# of piece_size bytes. Every piece is XORed as two big integers; whole blocks as integers would be slower.
+def _xor_pieces(block, key, position, piece_size):
+    size = len(block)
+    start = position % len(key)
+    stream = memoryview(key * ((start + size) // len(key) + 1))[start:start + size]
+    block = memoryview(block)
+    pieces = []
+    for offset in range(0, size, piece_size):
+        piece = block[offset:offset + piece_size]
+        xored = int.from_bytes(piece, 'little') ^ int.from_bytes(stream[offset:offset + piece_size], 'little')
+        pieces.append(xored.to_bytes(len(piece), 'little'))
+    return pieces
+
+
+# Marker sent down a chunk stream by BufferedWriteDecorator to ask for durability. Every layer passes it on after
+# everything it received before the marker has been passed on; FileDataSource then syncs the file to disk and
+# completes the marker. Layers that do not transform data need no special handling for it.
+class SyncPoint:
+    def __init__(self):
+        self.error = None
+        self.__event = threading.Event()
+
+    def done(self):
+        return self.__event.is_set()
+
+    # Only the first completion counts.
+    def complete(self, error=None):
+        if not self.__event.is_set():
+            self.error = error
+            self.__event.set()
+
+    def wait(self):
+        self.__event.wait()
+        if self.error is not None:
+            raise self.error
+
+
+# Common Component interface. Data flows through the components in chunks, so a payload of any size takes a constant
+# amount of memory. read_data and write_data are shortcuts for payloads that fit in memory.
 class DataSource:
-    def read_data(self):
+    # Yields the data as bytes-like chunks. A chunk may be a view of a reused buffer: it is valid only until the next
+    # chunk is requested, so it must be copied to be kept.
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
         raise NotImplementedError("Method is not implemented!")
 
-    def write_data(self, data):
+    # Replaces the data with the chunks of the given iterable.
+    def write_chunks(self, chunks):
+        raise NotImplementedError("Method is not implemented!")
+
+    # Adds the chunks of the given iterable at the end of the data.
+    def append_chunks(self, chunks):
         raise NotImplementedError("Method is not implemented!")
 
+    # Cuts the data down to its first size bytes.
+    def truncate(self, size):
+        raise NotImplementedError("Method is not implemented!")
+
+    def read_data(self):
+        data = bytearray()
+        for chunk in self.read_chunks():
+            data += chunk
+        return bytes(data)
+
+    def write_data(self, data):
+        self.write_chunks([_to_bytes(data)])
+
+    # Returns size bytes of the data starting at offset. This fallback streams the data up to the end of the range;
+    # components that can do better override it.
+    def read_range(self, offset, size):
+        data = bytearray()
+        position, end = 0, offset + size
+        for chunk in self.read_chunks():
+            chunk_end = position + len(chunk)
+            if chunk_end > offset:
+                data += chunk[max(offset - position, 0):end - position]
+            if chunk_end >= end:
+                break
+            position = chunk_end
+        return bytes(data)
+
+    def get_size(self):
+        return sum(len(chunk) for chunk in self.read_chunks())
+
 
-# One of the specific Components that implements the basic functionality.
+# One of the specific Components that implements the basic functionality. The file is read with readinto into one
+# reused buffer, and the chunks handed out are memoryview slices of it. Random reads go through a memory mapping of
+# the file: read_range returns a memoryview slice of the mapping, without copying anything. A file that does not exist
+# yet holds no data.
 class FileDataSource(DataSource):
     def __init__(self, filename):
         self.file = filename
+        # (inode, size, modification time) of the mapped file and a view of the whole mapping.
+        self.__mapped = None
+        self.__mapping = None
 
-    def read_data(self):
-        print('Data read from file')
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        try:
+            file = open(self.file, 'rb', buffering=0)
+        except FileNotFoundError:
+            return
+        with file:
+            while True:
+                size = file.readinto(buffer)
+                if not size:
+                    break
+                yield view[:size]
 
-    def write_data(self, data):
-        print('Data written to file')
+    # The old file is unlinked rather than truncated: views of its mapping that are still in use keep seeing the old
+    # data instead of crashing the process on access to truncated pages. A stream that has asked for durability with
+    # sync points is synced once more at its end, so whatever follows the last sync point is durable as well.
+    def write_chunks(self, chunks):
+        self.__mapped = self.__mapping = None
+        if os.path.exists(self.file):
+            os.unlink(self.file)
+        self.__write(chunks, 'wb')
+
+    def append_chunks(self, chunks):
+        self.__write(chunks, 'ab')
+
+    # A file that gets shorter is not cut in place either, since touching a view of the cut part of its mapping would
+    # kill the process with SIGBUS: its first size bytes are copied to a new file that replaces it.
+    def truncate(self, size):
+        self.__mapped = self.__mapping = None
+        if size >= self.get_size():
+            if os.path.exists(self.file):
+                os.truncate(self.file, size)
+            return
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file)))
+        try:
+            with open(self.file, 'rb') as source, os.fdopen(descriptor, 'wb') as target:
+                os.chmod(temporary_path, os.fstat(source.fileno()).st_mode & 0o7777)
+                self.__copy(source, target, size)
+            os.replace(temporary_path, self.file)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def read_range(self, offset, size):
+        return self.__map()[offset:offset + size]
+
+    def get_size(self):
+        try:
+            return os.path.getsize(self.file)
+        except FileNotFoundError:
+            return 0
+
+    def __write(self, chunks, mode):
+        synced = False
+        with open(self.file, mode) as file:
+            for chunk in chunks:
+                if isinstance(chunk, SyncPoint):
+                    file.flush()
+                    os.fsync(file.fileno())
+                    chunk.complete()
+                    synced = True
+                else:
+                    file.write(_to_bytes(chunk))
+            if synced:
+                file.flush()
+                os.fsync(file.fileno())
+
+    # Copies the first size bytes of the source file to the target file, within the kernel where it can.
+    @staticmethod
+    def __copy(source, target, size):
+        copied = 0
+        while copied < size:
+            if hasattr(os, 'copy_file_range'):
+                count = os.copy_file_range(source.fileno(), target.fileno(), size - copied)
+            else:
+                chunk = source.read(min(size - copied, CHUNK_SIZE))
+                count = target.write(chunk)
+            if not count:
+                break
+            copied += count
+
+    # The file is mapped again whenever it has changed since it was mapped, e.g. it was rewritten by another source.
+    # The previous mapping is released once the views of it are gone.
+    def __map(self):
+        try:
+            status = os.stat(self.file)
+        except FileNotFoundError:
+            self.__mapped = None
+            return memoryview(b'')
+        key = (status.st_ino, status.st_size, status.st_mtime_ns)
+        if key != self.__mapped:
+            if status.st_size:
+                with open(self.file, 'rb') as file:
+                    self.__mapping = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                self.__mapping = memoryview(b'')
+            self.__mapped = key
+        return self.__mapping
 
 
 # The parent of all Decorators contains the wrapping code.
@@ -27,48 +223,732 @@ class DataSourceDecorator(DataSource):
     def __init__(self, source):
         self.wrapper = source
 
-    def read_data(self):
-        return self.wrapper.read_data()
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        return self.wrapper.read_chunks(chunk_size)
 
-    def write_data(self, data):
-        self.wrapper.write_data(data)
+    def write_chunks(self, chunks):
+        self.wrapper.write_chunks(chunks)
+
+    def append_chunks(self, chunks):
+        self.wrapper.append_chunks(chunks)
+
+    def truncate(self, size):
+        self.wrapper.truncate(size)
+
+    def read_range(self, offset, size):
+        return self.wrapper.read_range(offset, size)
+
+    def get_size(self):
+        return self.wrapper.get_size()
 
+    # Returns the same decorator over another source, for compile_chain, or None when the decorator keeps state tied
+    # to its wrapped source and the stack below it must be left as it is.
+    def _rewrap(self, source):
+        return None
 
-# Concrete Decorators add something of their own to the basic behavior of the wrapped Component.
+
+# Concrete Decorators add something of their own to the basic behavior of the wrapped Component. This one XORs the
+# data with a repeating key, chunk by chunk. It is a toy cipher standing in for a real one, not actual protection.
 class EncryptionDecorator(DataSourceDecorator):
-    def read_data(self):
-        print('Data received from the read_data method of the wrapped object (wrapper).')
-        self.wrapper.read_data()
-        print('The data is decrypted.')
+    def __init__(self, source, key=b'decorator'):
+        super().__init__(source)
+        self.key = _to_bytes(key)
+        # The key repeated enough times to cover the largest chunk seen so far from any position.
+        self.__stream = b''
 
-    def write_data(self, data):
-        print('Data is encrypted.')
-        self.wrapper.write_data(data)
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        position = 0
+        for chunk in self.wrapper.read_chunks(chunk_size):
+            yield self._xor(chunk, position)
+            position += len(chunk)
+
+    def write_chunks(self, chunks):
+        self.wrapper.write_chunks(self.__encrypt(chunks, 0))
+
+    # The key stream goes on from where the data ends.
+    def append_chunks(self, chunks):
+        self.wrapper.append_chunks(self.__encrypt(chunks, self.wrapper.get_size()))
+
+    def read_range(self, offset, size):
+        return self._xor(self.wrapper.read_range(offset, size), offset)
+
+    def __encrypt(self, chunks, position):
+        for chunk in chunks:
+            if isinstance(chunk, SyncPoint):
+                yield chunk
+                continue
+            yield self._xor(chunk, position)
+            position += len(chunk)
 
+    # XORs the chunk that starts at the given position of the data with the key stream, as two big integers.
+    def _xor(self, chunk, position):
+        size = len(chunk)
+        start = position % len(self.key)
+        if len(self.__stream) < start + size:
+            self.__stream = self.key * ((start + size) // len(self.key) + 1)
+        stream = memoryview(self.__stream)[start:start + size]
+        return (int.from_bytes(chunk, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(size, 'little')
 
-# You can decorate not only base Components, but already wrapped objects.
+
+# You can decorate not only base Components, but already wrapped objects. This one cuts the data into blocks of
+# block_size bytes and compresses them independently with zlib on a pool of workers (zlib releases the GIL, so threads
+# are enough, but any executor will do). The output is framed:
+#   header: magic, block size;
+#   frames: raw size, compressed size and the compressed bytes of every block, then an empty frame marking the end;
+#   index: raw offset, raw size, frame offset and compressed size of every block;
+#   footer: offset of the index, number of blocks, total raw size, magic.
+# Sequential reads walk the frames and decompress several blocks ahead in parallel; read_range finds the blocks
+# covering the range in the index and decompresses only them. A sync point in the written stream ends the current
+# block early, so the header's block size is an upper bound.
+# append_chunks and truncate cut the data after its last kept frame, write the new frames there and finish with a
+# new end frame, index and footer. Until they are written, e.g. when the process dies in the middle of an append, the
+# data is recovered from its complete frames: data without a footer is read up to its first incomplete frame, so
+# everything a sync point has made durable can be read and appended to.
+# With a key, the decorator also does the work of an EncryptionDecorator with that key on top of it: every block is
+# XORed with the key stream in the same worker task that compresses or decompresses it. compile_chain fuses such
+# EncryptionDecorators into it.
 class CompressionDecorator(DataSourceDecorator):
-    def read_data(self):
-        print('Data received from the read_data method of the wrapped object (wrapper).')
-        self.wrapper.read_data()
-        print('The data is decompressed.')
+    header = struct.Struct('<4sI')
+    frame = struct.Struct('<II')
+    index_entry = struct.Struct('<QIQI')
+    footer = struct.Struct('<QQQ4s')
+    magic = b'ZBLK'
 
-    def write_data(self, data):
-        print('Data is compressed.')
-        self.wrapper.write_data(data)
+    def __init__(self, source, level=6, block_size=1024 * 1024, workers=None, executor=None, key=None):
+        super().__init__(source)
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.key = None if key is None else _to_bytes(key)
+        self.__index = None
+
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        with self.__pool() as pool:
+            decompressing = deque()
+            raw_position = 0
+            for raw_size, frame in self.__frames():
+                decompressing.append(pool.submit(self.__decompress_block, frame, raw_position, chunk_size))
+                raw_position += raw_size
+                if len(decompressing) > 2 * self.workers:
+                    yield from decompressing.popleft().result()
+            while decompressing:
+                yield from decompressing.popleft().result()
+
+    def write_chunks(self, chunks):
+        self.__index = None
+        self.wrapper.write_chunks(self.__compress(chunks, [], 0, 0))
+
+    def append_chunks(self, chunks):
+        self.__append(chunks, len(self.__read_index()[1]))
+
+    def truncate(self, size):
+        raw_offsets, entries, raw_size = self.__read_index()
+        if size >= raw_size:
+            return
+        number = bisect.bisect_right(raw_offsets, size) - 1
+        kept = []
+        if size > raw_offsets[number]:
+            frame = self.wrapper.read_range(entries[number][2] + self.frame.size, entries[number][3])
+            kept.append(self.__decompress_block(frame, raw_offsets[number])[:size - raw_offsets[number]])
+        self.__append(kept, number)
+
+    def read_range(self, offset, size):
+        raw_offsets, entries, raw_size = self.__read_index()
+        end = min(offset + size, raw_size)
+        if offset >= end:
+            return b''
+        first = bisect.bisect_right(raw_offsets, offset) - 1
+        last = bisect.bisect_left(raw_offsets, end) - 1
+        frames = [self.wrapper.read_range(entries[number][2] + self.frame.size, entries[number][3])
+                  for number in range(first, last + 1)]
+        if len(frames) == 1:
+            blocks = [self.__decompress_block(frames[0], raw_offsets[first])]
+        else:
+            with self.__pool() as pool:
+                blocks = list(pool.map(self.__decompress_block, frames, raw_offsets[first:last + 1]))
+        data = b''.join(blocks)
+        start = offset - raw_offsets[first]
+        return data[start:start + end - offset]
+
+    def get_size(self):
+        return self.__read_index()[2]
+
+    def _rewrap(self, source, key=None):
+        return CompressionDecorator(source, self.level, self.block_size, self.workers, self.executor,
+                                    self.key if key is None else key)
+
+    # Keeps the first blocks of the data, cuts off whatever follows their frames and appends the chunks after them.
+    def __append(self, chunks, blocks):
+        entries = self.__read_index()[1][:blocks]
+        self.__index = None
+        position = raw_position = 0
+        if entries:
+            raw_offset, raw_size, frame_offset, compressed_size = entries[-1]
+            position = frame_offset + self.frame.size + compressed_size
+            raw_position = raw_offset + raw_size
+        self.wrapper.truncate(position)
+        self.wrapper.append_chunks(self.__compress(chunks, entries, position, raw_position))
+
+    # Yields the frames of the chunks and the end of the data, going on after the given index entries. The position
+    # (of the next frame) and raw position (of the next block) are 0 when there is no header yet.
+    def __compress(self, chunks, entries, position, raw_position):
+        if not position:
+            yield self.header.pack(self.magic, self.block_size)
+            position = self.header.size
+        index = [self.index_entry.pack(*entry) for entry in entries]
+        with self.__pool() as pool:
+            compressing = deque()
+            submitted = raw_position
+
+            def submit(block):
+                nonlocal submitted
+                compressing.append((len(block), pool.submit(self.__compress_block, block, submitted)))
+                submitted += len(block)
+
+            def complete():
+                nonlocal position, raw_position
+                raw_size, compressed = compressing.popleft()
+                compressed = compressed.result()
+                index.append(self.index_entry.pack(raw_position, raw_size, position, len(compressed)))
+                position += self.frame.size + len(compressed)
+                raw_position += raw_size
+                return self.frame.pack(raw_size, len(compressed)) + compressed
+
+            block = bytearray()
+            for chunk in chunks:
+                if isinstance(chunk, SyncPoint):
+                    if block:
+                        submit(bytes(block))
+                        block.clear()
+                    while compressing:
+                        yield complete()
+                    yield chunk
+                    continue
+                block += chunk
+                while len(block) >= self.block_size:
+                    submit(bytes(block[:self.block_size]))
+                    del block[:self.block_size]
+                    # Only a few blocks are compressed ahead, so memory stays bounded however big the data is.
+                    while len(compressing) > 2 * self.workers:
+                        yield complete()
+            if block:
+                submit(bytes(block))
+            while compressing:
+                yield complete()
+        yield self.frame.pack(0, 0)
+        index_offset = position + self.frame.size
+        yield b''.join(index)
+        yield self.footer.pack(index_offset, len(index), raw_position, self.magic)
+
+    # Yields the raw size and the compressed bytes of every complete frame, reading the wrapped source sequentially. A
+    # header cut short holds no frame yet.
+    def __frames(self):
+        buffer = bytearray()
+        chunks = self.wrapper.read_chunks()
+
+        def fill(size):
+            while len(buffer) < size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return False
+                buffer.extend(chunk)
+            return True
+
+        if not fill(self.header.size):
+            return
+        magic, _ = self.header.unpack_from(buffer)
+        if magic != self.magic:
+            raise ValueError('The data is not compressed by CompressionDecorator')
+        position = self.header.size
+        while fill(position + self.frame.size):
+            raw_size, compressed_size = self.frame.unpack_from(buffer, position)
+            if not raw_size and not compressed_size:
+                return
+            position += self.frame.size
+            if not fill(position + compressed_size):
+                return
+            yield raw_size, bytes(buffer[position:position + compressed_size])
+            position += compressed_size
+            if position >= len(buffer) // 2:
+                del buffer[:position]
+                position = 0
+
+    # Returns the raw offsets of the blocks, their index entries and the total raw size.
+    def __read_index(self):
+        if self.__index is None:
+            size = self.wrapper.get_size()
+            entries = self.__read_footer(size)
+            if entries is None:
+                entries = self.__scan_frames(size)
+            raw_size = entries[-1][0] + entries[-1][1] if entries else 0
+            self.__index = ([entry[0] for entry in entries], entries, raw_size)
+        return self.__index
+
+    # Returns the index entries stored at the end of the data, or None when the data does not end with a footer.
+    def __read_footer(self, size):
+        if size < self.header.size + self.frame.size + self.footer.size:
+            return None
+        index_offset, count, _, magic = self.footer.unpack(
+            self.wrapper.read_range(size - self.footer.size, self.footer.size))
+        if magic != self.magic or index_offset + count * self.index_entry.size + self.footer.size != size:
+            return None
+        return list(self.index_entry.iter_unpack(
+            self.wrapper.read_range(index_offset, count * self.index_entry.size)))
+
+    # Rebuilds the index entries of data without a footer from the headers of its complete frames.
+    def __scan_frames(self, size):
+        entries = []
+        if size < self.header.size:
+            return entries
+        magic, _ = self.header.unpack(self.wrapper.read_range(0, self.header.size))
+        if magic != self.magic:
+            raise ValueError('The data is not compressed by CompressionDecorator')
+        position, raw_position = self.header.size, 0
+        while position + self.frame.size <= size:
+            raw_size, compressed_size = self.frame.unpack(self.wrapper.read_range(position, self.frame.size))
+            if not raw_size and not compressed_size or position + self.frame.size + compressed_size > size:
+                break
+            entries.append((raw_position, raw_size, position, compressed_size))
+            position += self.frame.size + compressed_size
+            raw_position += raw_size
+        return entries
+
+    # Both run in the workers, on the block that starts at the given raw position.
+    def __compress_block(self, block, raw_position):
+        if self.key is not None:
+            block = b''.join(_xor_pieces(block, self.key, raw_position, CHUNK_SIZE))
+        return zlib.compress(block, self.level)
+
+    # Returns the block cut into chunks of chunk_size bytes, or whole without a chunk size.
+    def __decompress_block(self, frame, raw_position, chunk_size=None):
+        block = zlib.decompress(frame)
+        if self.key is not None:
+            pieces = _xor_pieces(block, self.key, raw_position, chunk_size or CHUNK_SIZE)
+            return pieces if chunk_size else b''.join(pieces)
+        if not chunk_size:
+            return block
+        view = memoryview(block)
+        return [view[start:start + chunk_size] for start in range(0, len(block), chunk_size)]
+
+    def __pool(self):
+        if self.executor is not None:
+            return _Borrowed(self.executor)
+        return ThreadPoolExecutor(self.workers)
+
+
+# Bounded LRU of decoded blocks, keyed by (owner, block number). Several CachingDecorators can share one cache and its
+# byte budget; each of them is an owner whose blocks can be dropped at once.
+class BlockCache:
+    def __init__(self, capacity_bytes=64 * 1024 * 1024):
+        self.capacity_bytes = capacity_bytes
+        self.__blocks = OrderedDict()
+        # owner -> block numbers of its cached blocks
+        self.__owners = {}
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def size_in_bytes(self):
+        return self.__bytes
+
+    def get(self, owner, number):
+        with self.__lock:
+            block = self.__blocks.get((owner, number))
+            if block is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.__blocks.move_to_end((owner, number))
+            return block
+
+    def put(self, owner, number, block):
+        with self.__lock:
+            if (owner, number) in self.__blocks or len(block) > self.capacity_bytes:
+                return
+            self.__blocks[(owner, number)] = block
+            self.__owners.setdefault(owner, set()).add(number)
+            self.__bytes += len(block)
+            while self.__bytes > self.capacity_bytes:
+                self.__remove(*next(iter(self.__blocks)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, owner):
+        with self.__lock:
+            for number in list(self.__owners.get(owner, ())):
+                self.__remove(owner, number)
+                self.stats['invalidations'] += 1
+
+    def __remove(self, owner, number):
+        self.__bytes -= len(self.__blocks.pop((owner, number)))
+        numbers = self.__owners[owner]
+        numbers.discard(number)
+        if not numbers:
+            del self.__owners[owner]
+
+
+# This Decorator keeps the blocks read through it in a BlockCache, so hot regions are served from memory and the
+# layers below it (decryption, decompression, I/O) are skipped. It can be put at any level of the stack. Writes pass
+# through it and drop its cached blocks.
+class CachingDecorator(DataSourceDecorator):
+    def __init__(self, source, capacity_bytes=64 * 1024 * 1024, block_size=CHUNK_SIZE, cache=None):
+        super().__init__(source)
+        self.block_size = block_size
+        self.cache = cache if cache is not None else BlockCache(capacity_bytes)
+        self.__size = None
+
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        for number in range(-(-self.get_size() // self.block_size)):
+            view = memoryview(self.__block(number))
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+
+    def write_chunks(self, chunks):
+        try:
+            self.wrapper.write_chunks(chunks)
+        finally:
+            self.__invalidate()
+
+    def append_chunks(self, chunks):
+        try:
+            self.wrapper.append_chunks(chunks)
+        finally:
+            self.__invalidate()
+
+    def truncate(self, size):
+        try:
+            self.wrapper.truncate(size)
+        finally:
+            self.__invalidate()
+
+    def read_range(self, offset, size):
+        end = min(offset + size, self.get_size())
+        if offset >= end:
+            return b''
+        first, last = offset // self.block_size, (end - 1) // self.block_size
+        start = offset - first * self.block_size
+        if first == last:
+            return memoryview(self.__block(first))[start:start + end - offset]
+        data = b''.join(self.__block(number) for number in range(first, last + 1))
+        return data[start:start + end - offset]
+
+    def get_size(self):
+        if self.__size is None:
+            self.__size = self.wrapper.get_size()
+        return self.__size
+
+    def __invalidate(self):
+        self.__size = None
+        self.cache.invalidate(self)
+
+    def __block(self, number):
+        block = self.cache.get(self, number)
+        if block is None:
+            block = bytes(self.wrapper.read_range(number * self.block_size, self.block_size))
+            self.cache.put(self, number, block)
+        return block
+
+
+# This Decorator puts small writes behind a buffer. write appends to the data and returns at once; a background thread
+# hands the buffered bytes down the stack in big batches, once batch_size bytes are buffered or the oldest of them has
+# waited flush_interval seconds, all within one long append_chunks call of the wrapped source. flush returns once
+# everything written before it is on disk: the flushes of any number of writers that arrive while the previous sync is
+# in progress share the next one. Should the process die, the data is recovered up to the last flush, and a new
+# decorator over it goes on from there. close ends the append and finishes the data, and reading closes it first.
+# write_chunks replaces the data like everywhere else.
+class BufferedWriteDecorator(DataSourceDecorator):
+    def __init__(self, source, batch_size=1024 * 1024, flush_interval=0.05, max_buffered=None):
+        super().__init__(source)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Writers wait while this many bytes are buffered and not yet taken by the background thread.
+        self.max_buffered = max_buffered or 4 * batch_size
+        self.stats = {'writes': 0, 'batches': 0, 'syncs': 0}
+        self.__condition = threading.Condition()
+        self.__buffer = bytearray()
+        self.__buffered_at = None
+        # The sync point to send after the next batch, shared by the flushes waiting for it.
+        self.__sync = None
+        self.__closing = False
+        self.__thread = None
+        self.__error = None
+
+    def write(self, data):
+        data = _to_bytes(data)
+        with self.__condition:
+            self.__check()
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            while len(self.__buffer) >= self.max_buffered and self.__error is None:
+                self.__condition.wait()
+            self.__check()
+            # The background thread waits without a timeout while the buffer is empty, so it is woken up to start
+            # timing the first write into it.
+            if not self.__buffer:
+                self.__buffered_at = time.monotonic()
+                self.__condition.notify_all()
+            self.__buffer += data
+            self.stats['writes'] += 1
+            if len(self.__buffer) >= self.batch_size:
+                self.__condition.notify_all()
+
+    def flush(self):
+        with self.__condition:
+            self.__check()
+            if self.__thread is None:
+                return
+            if self.__sync is None:
+                self.__sync = SyncPoint()
+                self.__condition.notify_all()
+            sync = self.__sync
+        sync.wait()
+
+    def close(self):
+        with self.__condition:
+            thread = self.__thread
+            if thread is None:
+                return
+            if not self.__closing:
+                self.__closing = True
+                if self.__sync is None:
+                    self.__sync = SyncPoint()
+                self.__condition.notify_all()
+        thread.join()
+        with self.__condition:
+            if self.__thread is thread:
+                self.__thread, self.__closing = None, False
+            error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        self.close()
+        return self.wrapper.read_chunks(chunk_size)
+
+    def write_chunks(self, chunks):
+        self.truncate(0)
+        self.append_chunks(chunks)
+
+    def append_chunks(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+        self.close()
+
+    def truncate(self, size):
+        self.close()
+        self.wrapper.truncate(size)
+
+    def read_range(self, offset, size):
+        self.close()
+        return self.wrapper.read_range(offset, size)
+
+    def get_size(self):
+        self.close()
+        return self.wrapper.get_size()
+
+    def __check(self):
+        if self.__error is not None:
+            raise self.__error
+        if self.__closing:
+            raise ValueError('The buffered write is being closed')
+
+    def __run(self):
+        # Sync points sent down the stack and not completed yet.
+        in_flight = []
+        try:
+            self.wrapper.append_chunks(self.__batches(in_flight))
+        except BaseException as error:
+            with self.__condition:
+                self.__error = error
+                if self.__sync is not None:
+                    in_flight.append(self.__sync)
+                    self.__sync = None
+                self.__condition.notify_all()
+            for sync in in_flight:
+                sync.complete(error)
+        else:
+            # The wrapped source got the whole stream, even if it did not complete the sync points itself.
+            for sync in in_flight:
+                sync.complete()
+
+    # The chunk stream of the background write: batches of buffered bytes, with sync points after them as requested.
+    def __batches(self, in_flight):
+        while True:
+            with self.__condition:
+                while not self.__ready():
+                    self.__condition.wait(self.__timeout())
+                batch, self.__buffer = self.__buffer, bytearray()
+                sync, self.__sync = self.__sync, None
+                closing = self.__closing
+                self.__condition.notify_all()
+            if batch:
+                self.stats['batches'] += 1
+                yield batch
+            if sync is not None:
+                in_flight[:] = [pending for pending in in_flight if not pending.done()]
+                in_flight.append(sync)
+                self.stats['syncs'] += 1
+                yield sync
+            if closing:
+                return
+
+    def __ready(self):
+        if self.__sync is not None or self.__closing:
+            return True
+        return bool(self.__buffer) and (len(self.__buffer) >= self.batch_size or
+                                        time.monotonic() - self.__buffered_at >= self.flush_interval)
+
+    def __timeout(self):
+        if not self.__buffer:
+            return None
+        return max(self.__buffered_at + self.flush_interval - time.monotonic(), 0)
+
+
+# Compiles a stack of decorators into an equivalent one that makes fewer passes over the data. A run of adjacent
+# EncryptionDecorators becomes one EncryptionDecorator: XORing with several repeating keys is XORing with one key as
+# long as the least common multiple of their lengths, so every chunk is transformed once instead of once per layer
+# (runs whose merged key would exceed MAX_FUSED_KEY are split). A run right on top of a CompressionDecorator goes into
+# its key, so the blocks are XORed and compressed in one worker task, and the chunks are not XORed again after being
+# cut out of the blocks: Encryption > Compression > File compiles to Compression > File. Every XOR still makes new
+# bytes, since XORing big integers cannot write into a reused buffer. Other decorators are boundaries that are rebuilt
+# over the compiled stack below them. The given stack is not changed, and both stacks read and write the same data.
+def compile_chain(source):
+    keys = []
+    while isinstance(source, EncryptionDecorator):
+        keys.append(source.key)
+        source = source.wrapper
+    if isinstance(source, DataSourceDecorator):
+        wrapped = compile_chain(source.wrapper)
+        if wrapped is not source.wrapper:
+            source = source._rewrap(wrapped) or source
+    compression = isinstance(source, CompressionDecorator)
+    if compression and keys and source.key is not None:
+        keys.append(source.key)
+    # Every group is a list of keys, with the length of their merged key first.
+    groups = []
+    for key in keys:
+        length = math.lcm(groups[-1][0], len(key)) if groups else None
+        if length is not None and length <= MAX_FUSED_KEY:
+            groups[-1][0] = length
+            groups[-1].append(key)
+        else:
+            groups.append([len(key), key])
+    groups = [_merge_keys(group) if len(group) > 1 else group[0] for _, *group in groups]
+    if compression and groups:
+        source = source._rewrap(source.wrapper, groups.pop())
+    for key in reversed(groups):
+        source = EncryptionDecorator(source, key)
+    return source
+
+
+def _merge_keys(keys):
+    length = math.lcm(*(len(key) for key in keys))
+    merged = 0
+    for key in keys:
+        merged ^= int.from_bytes(key * (length // len(key)), 'little')
+    return merged.to_bytes(length, 'little')
+
+
+# Lets a shared executor be used in a with statement without being shut down at its end.
+class _Borrowed:
+    def __init__(self, executor):
+        self.executor = executor
+
+    def __enter__(self):
+        return self.executor
+
+    def __exit__(self, *exc_info):
+        return False
 
 
 if __name__ == '__main__':
+    directory = tempfile.TemporaryDirectory()
+    filename = os.path.join(directory.name, 'file.dat')
+
     # 1. A simple example of building and using decorators.
-    source = FileDataSource('file.dat')
+    source = FileDataSource(filename)
     source.write_data('data')
     # Clean data has been written to the file.
-    print()
+    print(source.read_data())
     source = CompressionDecorator(source)
     source.write_data('data')
     # Compressed data has been written to the file.
-    print()
+    print(source.read_data(), FileDataSource(filename).read_data()[:16])
     source = EncryptionDecorator(source)
     # source is a bunch of three objects: Encryption > Compression > FileDataSource
     source.write_data('data')
     # Compressed and encrypted data was written to the file.
+    print(source.read_data(), FileDataSource(filename).read_data()[:16])
+
+    # 2. Big payloads stream through the whole stack chunk by chunk, without being assembled in memory.
+    records = (f'record {number}\n'.encode() for number in range(1_000_000))
+    source.write_chunks(records)
+    total = sum(len(chunk) for chunk in source.read_chunks())
+    print(f'{total} bytes streamed back, {os.path.getsize(filename)} bytes on disk')
+
+    # 3. Blocks are compressed in parallel, and a random read decompresses only the blocks it needs.
+    source = CompressionDecorator(FileDataSource(filename), block_size=256 * 1024)
+    source.write_chunks(f'record {number}\n'.encode() for number in range(1_000_000))
+    print(source.get_size(), source.read_range(source.get_size() - 30, 30))
+
+    # 4. Small records are read straight out of the mapped file, through the decorators too.
+    source = FileDataSource(filename)
+    source.write_chunks(f'record {number:08}\n'.encode() for number in range(1_000_000))
+    record = source.read_range(16 * 123_456, 16)
+    print(type(record).__name__, bytes(record))
+    source = EncryptionDecorator(source)
+    source.write_chunks(f'record {number:08}\n'.encode() for number in range(1_000_000))
+    print(source.read_range(16 * 654_321, 16))
+
+    # 5. Repeated reads of hot records are served from the cache of decrypted and decompressed blocks.
+    source = CachingDecorator(EncryptionDecorator(CompressionDecorator(FileDataSource(filename))), block_size=4096)
+    source.write_chunks(f'record {number:08}\n'.encode() for number in range(1_000_000))
+    for _ in range(100):
+        source.read_range(16 * 500_000, 16)
+    print(bytes(source.read_range(16 * 500_000, 16)), source.cache.stats)
+
+    # 6. Many writers append small records through a write buffer and wait for them to be durable together. What is
+    # flushed can be read before the write is closed, as it could be after a crash.
+    log = os.path.join(directory.name, 'log.dat')
+    source = BufferedWriteDecorator(CompressionDecorator(FileDataSource(log)))
+
+    def ingest(writer):
+        for number in range(writer, 100_000, 8):
+            source.write(f'record {number:08}\n')
+            if number % 10_000 < 8:
+                source.flush()
+
+    writers = [threading.Thread(target=ingest, args=(writer,)) for writer in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    source.flush()
+    print(CompressionDecorator(FileDataSource(log)).get_size(), source.stats)
+    source.close()
+    source.write('record 00100000\n')
+    print(source.get_size())
+
+    # 7. A deep stack compiled into a shallower one gives the same results with fewer passes over the data.
+    source = EncryptionDecorator(EncryptionDecorator(EncryptionDecorator(CompressionDecorator(
+        EncryptionDecorator(EncryptionDecorator(FileDataSource(filename), b'inner'), b'layers')), b'three'), b'fused'),
+        b'keys')
+    fused = compile_chain(source)
+    layers, layer = [], fused
+    while isinstance(layer, DataSourceDecorator):
+        layers.append(type(layer).__name__)
+        layer = layer.wrapper
+    print(' > '.join(layers + [type(layer).__name__]))
+    source.write_chunks(f'record {number:08}\n'.encode() for number in range(1_000_000))
+    started = time.perf_counter()
+    data = source.read_data()
+    unfused_time = time.perf_counter() - started
+    started = time.perf_counter()
+    assert fused.read_data() == data
+    fused_time = time.perf_counter() - started
+    assert bytes(fused.read_range(16 * 777_777, 16)) == bytes(source.read_range(16 * 777_777, 16))
+    fused.write_chunks([b'written through the fused stack'])
+    assert source.read_data() == b'written through the fused stack'
+    print(f'read in {unfused_time:.2f}s unfused, {fused_time:.2f}s fused')
+    directory.cleanup()
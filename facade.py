@@ -1,5 +1,9 @@
 # A facade is a structural design pattern that provides a simple interface to a complex class system, library,
 # or framework.
+import os
+import threading
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, as_completed
+
 
 # Classes of a complex third-party video conversion framework. We have no control over this code, so we cannot
 # simplify it.
@@ -75,6 +79,137 @@ class VideoConverter:
         self.result = AudioMixer().fix(self.result)
         return self.result, self.format
 
+    # Converts many (filename, format) jobs on a pool of processes, so a backlog of files uses every core. At most
+    # max_workers jobs are handed to the pool at a time. A pool of max_workers processes is created and shut down
+    # when no executor is given. Returns a ConversionBatch at once.
+    def convert_many(self, jobs, max_workers=None, executor=None, ordered=True, on_progress=None):
+        return ConversionBatch(jobs, max_workers or os.cpu_count() or 1, executor, ordered, on_progress)
+
+
+# Runs one job in a worker process. Every job gets a converter of its own, as VideoConverter keeps the state of the
+# conversion in progress.
+def _convert(filename, fileformat):
+    return VideoConverter().convert(filename, fileformat)
+
+
+# A batch of conversions in progress. There is a Future for every job from the start, in the order of the jobs; a
+# dispatcher thread hands the jobs to the pool as earlier ones finish. Iterating over the batch yields (job, result)
+# pairs, in the order of the jobs or as they complete. on_progress(completed, total, job, future) is called once for
+# every job that finishes, fails or is cancelled, on whichever thread finished it. Used as a context manager, the
+# batch is waited for on exit, and cancelled first if the block raised.
+class ConversionBatch:
+    def __init__(self, jobs, max_workers, executor=None, ordered=True, on_progress=None):
+        self.jobs = list(jobs)
+        self.futures = [Future() for _ in self.jobs]
+        self.ordered = ordered
+        self.on_progress = on_progress
+        self.__completed = 0
+        self.__reported = 0
+        self.__lock = threading.Lock()
+        self.__all_reported = threading.Condition(self.__lock)
+        self.__slots = threading.Semaphore(max_workers)
+        self.__cancelled = threading.Event()
+        # Futures of the pool for the jobs handed to it and not finished yet, by job number.
+        self.__submitted = {}
+        self.__executor = executor
+        self.__owns_executor = executor is None
+        if self.__owns_executor:
+            self.__executor = ProcessPoolExecutor(max_workers)
+        for number, future in enumerate(self.futures):
+            future.add_done_callback(lambda future, number=number: self.__progress(number, future))
+        # Not a daemon, so the interpreter does not exit before the dispatcher has shut down the pool it owns.
+        self.__dispatcher = threading.Thread(target=self.__dispatch)
+        self.__dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+        self.wait()
+
+    def __iter__(self):
+        if self.ordered:
+            for job, future in zip(self.jobs, self.futures):
+                yield job, future.result()
+        else:
+            numbers = {future: number for number, future in enumerate(self.futures)}
+            for future in as_completed(self.futures):
+                yield self.jobs[numbers[future]], future.result()
+        self.wait()
+
+    def results(self):
+        self.wait()
+        return [future.result() for future in self.futures]
+
+    # Stops handing jobs to the pool and cancels the jobs that have not started. Jobs already converting finish.
+    def cancel(self):
+        self.__cancelled.set()
+        for future in self.futures:
+            future.cancel()
+        with self.__lock:
+            submitted = list(self.__submitted.values())
+        for pool_future in submitted:
+            pool_future.cancel()
+
+    # Returns once every job has finished and on_progress has been called for it, and the dispatcher has stopped.
+    def wait(self):
+        self.__dispatcher.join()
+        for future in self.futures:
+            try:
+                future.exception()
+            except CancelledError:
+                pass
+        with self.__all_reported:
+            self.__all_reported.wait_for(lambda: self.__reported == len(self.jobs))
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def __dispatch(self):
+        try:
+            for number, job in enumerate(self.jobs):
+                self.__slots.acquire()
+                if self.__cancelled.is_set() or not self.futures[number].set_running_or_notify_cancel():
+                    self.__slots.release()
+                    continue
+                try:
+                    pool_future = self.__executor.submit(_convert, *job)
+                except Exception as error:
+                    self.futures[number].set_exception(error)
+                    self.__slots.release()
+                    continue
+                with self.__lock:
+                    self.__submitted[number] = pool_future
+                pool_future.add_done_callback(lambda pool_future, number=number: self.__finish(number, pool_future))
+        finally:
+            if self.__owns_executor:
+                self.__executor.shutdown(cancel_futures=self.__cancelled.is_set())
+
+    def __finish(self, number, pool_future):
+        with self.__lock:
+            self.__submitted.pop(number, None)
+        self.__slots.release()
+        if pool_future.cancelled():
+            self.futures[number].set_exception(CancelledError())
+        elif pool_future.exception() is not None:
+            self.futures[number].set_exception(pool_future.exception())
+        else:
+            self.futures[number].set_result(pool_future.result())
+
+    def __progress(self, number, future):
+        with self.__lock:
+            self.__completed += 1
+            completed = self.__completed
+        try:
+            if self.on_progress is not None:
+                self.on_progress(completed, len(self.jobs), self.jobs[number], future)
+        finally:
+            with self.__all_reported:
+                self.__reported += 1
+                self.__all_reported.notify_all()
+
 
 # The application does not depend on a complex video conversion framework. By the way, if you suddenly decide to
 # change the framework, you will only need to rewrite Facade.
@@ -82,3 +217,14 @@ if __name__ == '__main__':
     convertor = VideoConverter()
     mp4 = convertor.convert("youtubevideo.ogg", "mp4")
     print(mp4)
+
+    # A whole backlog of files is converted on every core, with the results in the order of the jobs.
+    jobs = [(f'video{number}.ogg', 'mp4' if number % 2 else 'ogg') for number in range(100)]
+
+    def report(completed, total, job, future):
+        if completed % 25 == 0:
+            print(f'{completed}/{total} converted')
+
+    with convertor.convert_many(jobs, on_progress=report) as batch:
+        results = batch.results()
+    print(jobs[99], results[99])
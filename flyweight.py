@@ -1,5 +1,15 @@
 # Flyweight is a structural design pattern which allows you to fit more objects into the allocated RAM due to
 # economical sharing the general state of objects among themselves, instead of storing the same data in every object.
+import array
+import itertools
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 
 # Flyweight TreeType class contains some of the fields that describe Trees. These fields are not unique for each Tree,
 # unlike, for example, coordinates - several Trees can have the same texture.
@@ -13,18 +23,77 @@ class TreeType:
     def draw(self, x, y):
         print(f'{self.__color} {self.__texture} {self.__name} tree is painted at coordinates ({x},{y})')
 
+    # Draws many trees of this type at once, with the same lines as draw(). Lines are formatted in batches by a single
+    # join and every batch goes to the binary sink with a single write call. Without a sink they go to standard output,
+    # as text if it has been replaced by a text stream without a binary buffer.
+    def draw_many(self, xs, ys, sink=None, batch_size=64 * 1024):
+        encode = True
+        if sink is None:
+            sys.stdout.flush()
+            sink = getattr(sys.stdout, 'buffer', None)
+            if sink is None:
+                sink, encode = sys.stdout, False
+        prefix = f'{self.__color} {self.__texture} {self.__name} tree is painted at coordinates ('
+        separator = '\n' + prefix
+        # str.format converts the coordinates as the f-string in draw() does.
+        coordinates = map('{},{})'.format, xs, ys)
+        while True:
+            lines = list(itertools.islice(coordinates, batch_size))
+            if not lines:
+                break
+            batch = prefix + separator.join(lines) + '\n'
+            sink.write(batch.encode() if encode else batch)
+
 
-# Flyweight factory decides when to create a new Flyweight and when to make do with an existing one.
+# Flyweight factory decides when to create a new Flyweight and when to make do with an existing one. Lookups are
+# atomic, so concurrent loaders never create two Flyweights for the same key. The factory can be bounded with
+# configure(): by default the least recently used types beyond the capacity are forgotten, while in the weak mode a
+# type is kept as long as anything else references it, plus the capacity most recently used ones.
 class TreeFactory:
-    tree_types = {}
+    tree_types = OrderedDict()
+    capacity = None
+    weak = False
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    __lock = threading.Lock()
+    # Strong references to the most recently used types in the weak mode.
+    __recent = OrderedDict()
+
+    # Reconfigures the factory and forgets all types created so far.
+    @classmethod
+    def configure(cls, capacity=None, weak=False):
+        with cls.__lock:
+            cls.capacity = capacity
+            cls.weak = weak
+            cls.tree_types = weakref.WeakValueDictionary() if weak else OrderedDict()
+            cls.__recent = OrderedDict()
+            cls.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 
     @classmethod
     def get_tree_type(cls, name, color, texture):
-        if (name, color, texture) in cls.tree_types:
-            tree_type = cls.tree_types[(name, color, texture)]
+        with cls.__lock:
+            return cls.__get_or_create((name, color, texture))
+
+    # Looks up many (name, color, texture) keys at once, taking the lock a single time.
+    @classmethod
+    def get_tree_types(cls, keys):
+        with cls.__lock:
+            return [cls.__get_or_create(tuple(key)) for key in keys]
+
+    @classmethod
+    def __get_or_create(cls, key):
+        tree_type = cls.tree_types.get(key)
+        if tree_type is None:
+            cls.stats['misses'] += 1
+            tree_type = cls.tree_types[key] = TreeType(*key)
         else:
-            tree_type = TreeType(name, color, texture)
-            cls.tree_types[(name, color, texture)] = tree_type
+            cls.stats['hits'] += 1
+        if cls.capacity is not None:
+            used = cls.__recent if cls.weak else cls.tree_types
+            used[key] = tree_type
+            used.move_to_end(key)
+            while len(used) > cls.capacity:
+                used.popitem(last=False)
+                cls.stats['evictions'] += 1
         return tree_type
 
 
@@ -39,6 +108,202 @@ class Tree:
         return self.tree_type.draw(x, y)
 
 
+# Uniform grid spatial index. The plane is cut into square cells, and each cell remembers the items inside it, so a
+# query looks only at the cells that overlap the searched area, and its time depends on the size of the result and
+# not on the total number of items.
+class SpatialGrid:
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        # (column, row) -> {item: (x, y)}
+        self.__cells = {}
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def insert(self, item, x, y):
+        self.__cells.setdefault(self.__cell(x, y), {})[item] = (x, y)
+        self.__count += 1
+
+    def remove(self, item, x, y):
+        cell = self.__cell(x, y)
+        items = self.__cells[cell]
+        del items[item]
+        if not items:
+            del self.__cells[cell]
+        self.__count -= 1
+
+    # Inserts many (item, x, y) triples at once.
+    def bulk_load(self, entries):
+        cells = self.__cells
+        size = self.cell_size
+        count = 0
+        for item, x, y in entries:
+            key = (int(x // size), int(y // size))
+            items = cells.get(key)
+            if items is None:
+                items = cells[key] = {}
+            items[item] = (x, y)
+            count += 1
+        self.__count += count
+
+    # Yields the items with x0 <= x <= x1 and y0 <= y <= y1.
+    def query_rect(self, x0, y0, x1, y1):
+        for item, _, _ in self.__points_in_rect(x0, y0, x1, y1):
+            yield item
+
+    # Yields the items at most radius away from (x, y).
+    def query_radius(self, x, y, radius):
+        squared_radius = radius * radius
+        for item, item_x, item_y in self.__points_in_rect(x - radius, y - radius, x + radius, y + radius):
+            if (item_x - x) ** 2 + (item_y - y) ** 2 <= squared_radius:
+                yield item
+
+    def __points_in_rect(self, x0, y0, x1, y1):
+        first_column, first_row = self.__cell(x0, y0)
+        last_column, last_row = self.__cell(x1, y1)
+        width, height = last_column - first_column + 1, last_row - first_row + 1
+        if width <= 0 or height <= 0:
+            return
+        # When the area covers more cells than there are occupied ones, it is cheaper to walk the occupied cells.
+        if width * height > len(self.__cells):
+            keys = [(column, row) for column, row in self.__cells
+                    if first_column <= column <= last_column and first_row <= row <= last_row]
+        else:
+            keys = [(column, row) for column in range(first_column, last_column + 1)
+                    for row in range(first_row, last_row + 1)]
+        for column, row in keys:
+            items = self.__cells.get((column, row))
+            if not items:
+                continue
+            # Cells lying strictly inside the area need no coordinate checks.
+            inside = first_column < column < last_column and first_row < row < last_row
+            for item, (x, y) in items.items():
+                if inside or x0 <= x <= x1 and y0 <= y <= y1:
+                    yield item, x, y
+
+    def __cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+
+# When there are millions of trees, even a small Tree object costs too much. Forest keeps the unique state of trees
+# in contiguous arrays instead: x and y coordinates and the index of the tree type in the palette of the forest. With
+# the default typecodes a tree takes 10 bytes. The palette holds the Flyweights themselves, each of them only once.
+# Trees are identified by their position in the arrays. An optional spatial index over these positions makes region
+# queries cheap.
+class Forest:
+    def __init__(self, coordinate_typecode='i', index=None):
+        self.xs = array.array(coordinate_typecode)
+        self.ys = array.array(coordinate_typecode)
+        self.type_ids = array.array('H')
+        self.__types = []
+        self.__type_ids = {}
+        self.index = None
+        if index is not None:
+            self.attach_index(index)
+
+    def __len__(self):
+        return len(self.type_ids)
+
+    # Iterates over the trees as (x, y, tree_type) tuples.
+    def __iter__(self):
+        types = self.__types
+        for x, y, type_id in zip(self.xs, self.ys, self.type_ids):
+            yield x, y, types[type_id]
+
+    # Returns the tree at the given position as (x, y, tree_type).
+    def get_tree(self, position):
+        return self.xs[position], self.ys[position], self.__types[self.type_ids[position]]
+
+    def get_tree_types(self):
+        return list(self.__types)
+
+    # Indexes all trees planted so far; the index is then kept up to date by plant, plant_many and remove.
+    def attach_index(self, index):
+        index.bulk_load(zip(range(len(self)), self.xs, self.ys))
+        self.index = index
+
+    # The small integer id under which the tree type is stored in the palette. Ids are stored as unsigned shorts, so
+    # a forest holds at most 65536 types; the check comes before any column is changed.
+    def type_id(self, tree_type):
+        type_id = self.__type_ids.get(tree_type)
+        if type_id is None:
+            if len(self.__types) >= 1 << 16:
+                raise OverflowError('a forest cannot hold more than 65536 tree types')
+            type_id = self.__type_ids[tree_type] = len(self.__types)
+            self.__types.append(tree_type)
+        return type_id
+
+    def plant(self, x, y, name, color, texture):
+        type_id = self.type_id(TreeFactory.get_tree_type(name, color, texture))
+        if self.index is not None:
+            self.index.insert(len(self), x, y)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.type_ids.append(type_id)
+
+    # Plants trees of the same type at all the given coordinates at once.
+    def plant_many(self, xs, ys, tree_type):
+        xs = array.array(self.xs.typecode, xs)
+        ys = array.array(self.ys.typecode, ys)
+        if len(xs) != len(ys):
+            raise ValueError('xs and ys must have the same length')
+        type_id = self.type_id(tree_type)
+        if self.index is not None:
+            self.index.bulk_load(zip(range(len(self), len(self) + len(xs)), xs, ys))
+        self.xs.extend(xs)
+        self.ys.extend(ys)
+        self.type_ids.extend(array.array('H', [type_id]) * len(xs))
+
+    # Removes the tree at the given position in constant time: the last tree takes its place.
+    def remove(self, position):
+        last = len(self) - 1
+        if self.index is not None:
+            self.index.remove(position, self.xs[position], self.ys[position])
+            if position != last:
+                self.index.remove(last, self.xs[last], self.ys[last])
+                self.index.insert(position, self.xs[last], self.ys[last])
+        for column in (self.xs, self.ys, self.type_ids):
+            column[position] = column[last]
+            column.pop()
+
+    # Positions of the trees with x0 <= x <= x1 and y0 <= y <= y1. Without an index, all trees are scanned.
+    def query_rect(self, x0, y0, x1, y1):
+        if self.index is not None:
+            return list(self.index.query_rect(x0, y0, x1, y1))
+        return [position for position, (x, y) in enumerate(zip(self.xs, self.ys))
+                if x0 <= x <= x1 and y0 <= y <= y1]
+
+    # Positions of the trees at most radius away from (x, y).
+    def query_radius(self, x, y, radius):
+        if self.index is not None:
+            return list(self.index.query_radius(x, y, radius))
+        squared_radius = radius * radius
+        return [position for position, (tree_x, tree_y) in enumerate(zip(self.xs, self.ys))
+                if (tree_x - x) ** 2 + (tree_y - y) ** 2 <= squared_radius]
+
+    # Draws the trees grouped by type, in large buffered writes to the binary sink (standard output by default). The
+    # positions are sorted by type once, so the cost does not grow with the number of types.
+    def draw(self, sink=None):
+        if len(self.__types) == 1:
+            self.__types[0].draw_many(self.xs, self.ys, sink)
+            return
+        type_of = self.type_ids.__getitem__
+        for type_id, positions in itertools.groupby(sorted(range(len(self.type_ids)), key=type_of), type_of):
+            positions = list(positions)
+            self.__types[type_id].draw_many(map(self.xs.__getitem__, positions), map(self.ys.__getitem__, positions),
+                                            sink)
+
+    # Draws only the trees visible in the viewport.
+    def draw_viewport(self, x0, y0, x1, y1):
+        for position in self.query_rect(x0, y0, x1, y1):
+            x, y, tree_type = self.get_tree(position)
+            tree_type.draw(x, y)
+
+    def size_in_bytes(self):
+        return sum(column.itemsize * len(column) for column in (self.xs, self.ys, self.type_ids))
+
+
 if __name__ == '__main__':
     type1 = TreeFactory.get_tree_type('african', 'red', 'smooth')
 
@@ -52,3 +317,28 @@ if __name__ == '__main__':
     tree3.draw(2, 1)
 
     print(f'3 trees were painted but, there is only {len(TreeFactory.tree_types)} object of Tree types')
+
+    forest = Forest()
+    forest.plant(1, 1, 'oak', 'green', 'rough')
+    forest.plant_many(range(1_000_000), range(1_000_000), type1)
+    forest.plant_many([3, 8], [4, 2], TreeFactory.get_tree_type('birch', 'white', 'striped'))
+    print(f'{len(forest)} trees of {len(forest.get_tree_types())} types take {forest.size_in_bytes()} bytes')
+    with open(os.devnull, 'wb') as sink:
+        started = time.perf_counter()
+        forest.draw(sink)
+    print(f'The forest was painted in {time.perf_counter() - started:.2f} seconds')
+    for x, y, tree_type in itertools.islice(forest, 2):
+        tree_type.draw(x, y)
+
+    # Loaders running in parallel intern the same textures, and each key still gets a single Flyweight.
+    TreeFactory.configure(capacity=100, weak=True)
+    keys = [('pine', 'green', f'texture {number % 10}') for number in range(10_000)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        loaded = pool.map(TreeFactory.get_tree_types, [keys[start:start + 100] for start in range(0, len(keys), 100)])
+        unique = {id(tree_type) for tree_types in loaded for tree_type in tree_types}
+    print(f'{len(unique)} unique tree types, factory stats: {TreeFactory.stats}')
+
+    forest.attach_index(SpatialGrid(cell_size=100))
+    print('Trees in the viewport (2, 0) - (9, 5):')
+    forest.draw_viewport(2, 0, 9, 5)
+    print(f'{len(forest.query_radius(500_000, 500_000, 10))} trees within 10 units of (500000, 500000)')
@@ -1,8 +1,25 @@
 # Prototype is a creational design pattern which allows you to copy objects without going into details of their
 # implementation.
+import array
+import struct
+import sys
+import time
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
-# Basic prototype
+
+# Names of the fields of a shape class: the public slots of the classes it is made of.
+def _field_names(cls):
+    return [name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ())
+            if not name.startswith('_')]
+
+
+# Basic prototype. Fields are slots, so shapes have no per-instance __dict__: a clone is one small object, and copying
+# it is a few reference copies, whatever the fields hold.
 class Shape:
+    __slots__ = ('x', 'y', 'color')
+
     # Copying of all fields of the object occurs in the constructor.
     def __init__(self, source=None):
         if source is not None:
@@ -38,6 +55,8 @@ class Shape:
 # executed, the new object does not yet exist. But as soon as the constructor is completed, we get a completely
 # finished clone object, and not an empty object that needs to be filled.
 class Rectangle(Shape):
+    __slots__ = ('width', 'height')
+
     def __init__(self, source=None):
         super().__init__(source=source)
         if source is not None:
@@ -61,6 +80,8 @@ class Rectangle(Shape):
 
 
 class Circle(Shape):
+    __slots__ = ('radius',)
+
     def __init__(self, source=None):
         # The call to the parent constructor is needed to copy potential private fields declared in the parent class.
         super().__init__(source=source)
@@ -77,6 +98,322 @@ class Circle(Shape):
         return Circle(source=self)
 
 
+# view class -> shape class it stands for
+_shape_classes = {}
+
+
+# The class a shape stands for, the same for a view and a plain shape.
+def _shape_class(shape):
+    return _shape_classes.get(type(shape), type(shape))
+
+
+# Shapes taken out of a ShapeBatch by indexing or iteration are views: their fields read and write the columns of the
+# batch, so changing them changes the batch. They belong to a subclass of the prototype's class, made once per class,
+# so every shape method works on them.
+def _batch_field(name):
+    def get(self):
+        try:
+            return self._batch.get(self._index, name)
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def set(self, value):
+        self._batch.set(self._index, name, value)
+
+    return property(get, set)
+
+
+class _BatchView:
+    __slots__ = ()
+
+    # Returns a separate shape with the current fields of this one.
+    def to_shape(self):
+        return self._batch.materialize(self._index)
+
+
+# shape class -> class of the views of its batches
+_batch_view_classes = {}
+
+
+def _batch_view_class(cls):
+    view_class = _batch_view_classes.get(cls)
+    if view_class is None:
+        namespace = {name: _batch_field(name) for name in _field_names(cls)}
+        namespace['__slots__'] = ('_batch', '_index')
+        view_class = type(cls.__name__, (_BatchView, cls), namespace)
+        _shape_classes[view_class] = cls
+        _batch_view_classes[cls] = view_class
+    return view_class
+
+
+# Many shapes stamped from one prototype, stored column by column. A field that is the same for all shapes is stored
+# once, and a field that varies gets its own column: an array for numbers and a list for anything else. Shape objects
+# are built only by materialize; indexing and iteration give views of the batch.
+class ShapeBatch:
+    def __init__(self, prototype, count, overrides=None):
+        self.prototype = prototype
+        self.__count = count
+        self.__constants = {name: getattr(prototype, name) for name in _field_names(_shape_class(prototype))
+                            if hasattr(prototype, name)}
+        self.__columns = {}
+        for name, value in (overrides or {}).items():
+            self.set_field(name, value)
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        view_class = _batch_view_class(_shape_class(self.prototype))
+        for index in range(self.__count):
+            yield self.__view(view_class, index)
+
+    def __getitem__(self, index):
+        return self.__view(_batch_view_class(_shape_class(self.prototype)), range(self.__count)[index])
+
+    # Builds a separate shape with the current fields of the shape at the index.
+    def materialize(self, index):
+        index = range(self.__count)[index]
+        shape = _shape_class(self.prototype)()
+        for name, value in self.__constants.items():
+            setattr(shape, name, value)
+        for name, column in self.__columns.items():
+            setattr(shape, name, column[index])
+        return shape
+
+    # Sets the field of all shapes: a sequence with a value per shape, or a single value for all of them. Other
+    # iterables are refused, since they can be neither.
+    def set_field(self, name, value):
+        if isinstance(value, (list, tuple, range, array.array)):
+            if len(value) != self.__count:
+                raise ValueError(f'{name} must have {self.__count} values')
+            self.__columns[name] = self.__column(value)
+            self.__constants.pop(name, None)
+        elif isinstance(value, Iterable) and not isinstance(value, (str, bytes)):
+            raise TypeError(f'{name} must be a list, tuple, range or array with a value per shape, or a single value')
+        else:
+            self.__constants[name] = value
+            self.__columns.pop(name, None)
+
+    def get(self, index, name):
+        column = self.__columns.get(name)
+        if column is None:
+            return self.__constants[name]
+        return column[index]
+
+    def set(self, index, name, value):
+        column = self.__columns.get(name)
+        if column is None:
+            column = self.__columns[name] = self.__column([self.__constants.pop(name)] * self.__count)
+        try:
+            column[index] = value
+        except (TypeError, OverflowError):
+            # The value does not fit the typecode of the array, so the column falls back to a list.
+            column = self.__columns[name] = list(column)
+            column[index] = value
+
+    def size_in_bytes(self):
+        return sum(sys.getsizeof(column) for column in self.__columns.values())
+
+    def __view(self, view_class, index):
+        view = view_class.__new__(view_class)
+        view._batch = self
+        view._index = index
+        return view
+
+    @staticmethod
+    def __column(values):
+        if all(type(value) is int for value in values):
+            try:
+                return array.array('q', values)
+            except OverflowError:
+                return list(values)
+        if all(type(value) in (int, float) for value in values):
+            return array.array('d', values)
+        return list(values)
+
+
+# Registry of named prototypes. Clients ask it for copies by name and do not need to know where the prototypes come
+# from. clone_many stamps large batches of copies at once.
+class PrototypeRegistry:
+    def __init__(self):
+        self.__prototypes = {}
+
+    def register(self, name, prototype):
+        self.__prototypes[name] = prototype
+
+    def unregister(self, name):
+        del self.__prototypes[name]
+
+    def get(self, name):
+        return self.__prototypes[name]
+
+    def clone(self, name, **overrides):
+        shape = self.__prototypes[name].clone()
+        for field, value in overrides.items():
+            setattr(shape, field, value)
+        return shape
+
+    # Returns n copies as a ShapeBatch. Every override is either one value for all copies or a sequence of n values.
+    def clone_many(self, name, n, **overrides):
+        return ShapeBatch(self.__prototypes[name], n, overrides)
+
+
+# A read-write view of one shape in a SharedShapeBuffer. Every access goes straight to the shared bytes. Like batch
+# views, views of shared shapes belong to a subclass of the class of the record's kind, made once per class, so they
+# have only the fields of that kind and every shape method works on them.
+def _shared_field(name):
+    def get(self):
+        return self._buffer.get(self._index, name)
+
+    def set(self, value):
+        self._buffer.set(self._index, name, value)
+
+    return property(get, set)
+
+
+class SharedShapeView:
+    __slots__ = ()
+
+    def to_shape(self):
+        return self._buffer.materialize(self._index)
+
+
+# shape class -> class of the views of its shared records
+_shared_view_classes = {}
+
+
+def _shared_view_class(cls):
+    view_class = _shared_view_classes.get(cls)
+    if view_class is None:
+        namespace = {name: _shared_field(name) for name in _field_names(cls)}
+        namespace['__slots__'] = ('_buffer', '_index')
+        view_class = type(cls.__name__, (SharedShapeView, cls), namespace)
+        _shape_classes[view_class] = cls
+        _shared_view_classes[cls] = view_class
+    return view_class
+
+
+# Shapes in a fixed binary layout inside multiprocessing shared memory, so worker processes can map the same bytes
+# instead of receiving pickled objects. A 16-byte header holds a magic and the number of shapes, followed by one
+# 56-byte record per shape: the kind, x, y, two dimensions (width and height, or radius and 0) as doubles and the
+# color as up to 16 bytes of UTF-8. Shapes are rebuilt as objects only by materialize().
+class SharedShapeBuffer:
+    magic = b'SHP1'
+    header = struct.Struct('<4sI8x')
+    record = struct.Struct('<B7xdddd16s')
+    kinds = {Rectangle: 1, Circle: 2}
+    classes = {kind: cls for cls, kind in kinds.items()}
+    # field -> (offset inside the record, format)
+    fields = {
+        'x': (8, struct.Struct('<d')),
+        'y': (16, struct.Struct('<d')),
+        'width': (24, struct.Struct('<d')),
+        'radius': (24, struct.Struct('<d')),
+        'height': (32, struct.Struct('<d')),
+        'color': (40, struct.Struct('<16s')),
+    }
+
+    def __init__(self, memory):
+        self.memory = memory
+        magic, self.__count = self.header.unpack_from(memory.buf)
+        if magic != self.magic:
+            raise ValueError(f'{memory.name} does not hold shapes')
+
+    # Copies the shapes (a list, a ShapeBatch or any other sized iterable) into new shared memory. If a shape cannot
+    # be stored, the memory is freed again before the error is raised.
+    @classmethod
+    def create(cls, shapes, name=None):
+        memory = shared_memory.SharedMemory(name, create=True, size=cls.header.size + len(shapes) * cls.record.size)
+        try:
+            buffer = memory.buf
+            cls.header.pack_into(buffer, 0, cls.magic, len(shapes))
+            offset = cls.header.size
+            for shape in shapes:
+                kind = cls.kinds[_shape_class(shape)]
+                if kind == 1:
+                    first, second = shape.width, shape.height
+                else:
+                    first, second = shape.radius, 0.0
+                cls.record.pack_into(buffer, offset, kind, shape.x, shape.y, first, second, cls.__encode(shape.color))
+                offset += cls.record.size
+            return cls(memory)
+        except BaseException:
+            memory.close()
+            memory.unlink()
+            raise
+
+    # Maps shared memory created by another process.
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, index):
+        index = range(self.__count)[index]
+        view_class = _shared_view_class(self.classes[self.memory.buf[self.__record_offset(index)]])
+        view = view_class.__new__(view_class)
+        view._buffer = self
+        view._index = index
+        return view
+
+    def get(self, index, field):
+        offset, form = self.fields[field]
+        value = form.unpack_from(self.memory.buf, self.__record_offset(index) + offset)[0]
+        return value.rstrip(b'\0').decode() if field == 'color' else value
+
+    def set(self, index, field, value):
+        offset, form = self.fields[field]
+        if field == 'color':
+            value = self.__encode(value)
+        form.pack_into(self.memory.buf, self.__record_offset(index) + offset, value)
+
+    def materialize(self, index):
+        kind, x, y, first, second, color = self.record.unpack_from(self.memory.buf, self.__record_offset(index))
+        shape = self.classes[kind]()
+        shape.x, shape.y, shape.color = x, y, color.rstrip(b'\0').decode()
+        if kind == 1:
+            shape.width, shape.height = first, second
+        else:
+            shape.radius = first
+        return shape
+
+    def close(self):
+        self.memory.close()
+
+    # Frees the shared memory; done once, by the process that created it.
+    def unlink(self):
+        self.memory.unlink()
+
+    def __record_offset(self, index):
+        if not 0 <= index < self.__count:
+            raise IndexError('shape index out of range')
+        return self.header.size + index * self.record.size
+
+    @staticmethod
+    def __encode(color):
+        encoded = color.encode()
+        if len(encoded) > 16:
+            raise ValueError(f'color {color!r} is longer than 16 bytes')
+        return encoded
+
+
+# A worker that moves a range of shared shapes in place.
+def move_shared_shapes(name, start, stop, dx, dy):
+    shapes = SharedShapeBuffer.attach(name)
+    try:
+        for index in range(start, stop):
+            shapes.set(index, 'x', shapes.get(index, 'x') + dx)
+            shapes.set(index, 'y', shapes.get(index, 'y') + dy)
+    finally:
+        shapes.close()
+
+
 if __name__ == '__main__':
     shapes = []
 
@@ -114,3 +451,35 @@ if __name__ == '__main__':
     print(circle1.get_color() == circle2.get_color())
 
     # The shapes_copy variable will contain exact copies of the elements of the shapes array.
+
+    # Slotted clones are cheap to make in bulk, and every clone is independent of its prototype.
+    started = time.perf_counter()
+    stamps = [rectangle1.clone() for _ in range(100_000)]
+    print(f'100000 clones: {time.perf_counter() - started:.3f} seconds, {sys.getsizeof(stamps[0])} bytes each')
+    stamps[0].set_color('blue')
+    rectangle1.set_x(99)
+    print(stamps[0].get_color(), stamps[1].get_color(), stamps[1].get_x(), rectangle1.get_color())
+
+    # Named prototypes are stamped in batches.
+    registry = PrototypeRegistry()
+    registry.register('yellow rectangle', rectangle1)
+    registry.register('red circle', circle1)
+    print(registry.clone('red circle', radius=3).get_radius())
+    started = time.perf_counter()
+    batch = registry.clone_many('yellow rectangle', 1_000_000, x=range(1_000_000), y=range(1_000_000))
+    print(f'1000000 rectangles stamped in {time.perf_counter() - started:.3f} seconds, {batch.size_in_bytes()} bytes')
+    batch.set(7, 'color', 'green')
+    print(batch[7].get_x(), batch[7].get_color(), batch[-1].get_x(), batch[-1].get_width())
+
+    # Worker processes update the same shared shapes in place, nothing is pickled but the name of the memory.
+    shared = SharedShapeBuffer.create(registry.clone_many('red circle', 1000, x=range(1000)))
+    try:
+        with ProcessPoolExecutor(max_workers=4) as pool:
+            moves = [pool.submit(move_shared_shapes, shared.name, start, start + 250, 10, 20)
+                     for start in range(0, len(shared), 250)]
+            for move in moves:
+                move.result()
+        print(shared[999].get_x(), shared[999].get_y(), shared[999].get_color(), shared[999].to_shape().get_radius())
+    finally:
+        shared.close()
+        shared.unlink()
@@ -1,6 +1,22 @@
 # Proxy is a structural design pattern, which allows you to substitute special replacement objects instead of real
 # objects. These objects intercept calls to the original object, allowing to do something before or after passing the
 # call to the original.
+import asyncio
+import bisect
+import hashlib
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Marks a missing cache entry, since None is a perfectly valid cached answer.
+_MISSING = object()
+
 
 # Service interface.
 class YouTubeServiceBaseClass:
@@ -13,6 +29,10 @@ class YouTubeServiceBaseClass:
     def download_video(self, id):
         raise NotImplementedError("Method is not implemented!")
 
+    # Yields the video in chunks of bytes, so it never has to be held in memory as a whole.
+    def stream_video(self, id, chunk_size=64 * 1024):
+        raise NotImplementedError("Method is not implemented!")
+
 
 # The specific implementation of Service. The methods of this class ask YouTube for various information. The
 # speed of the request depends on the user's Internet channel and the state of YouTube itself. The more calls to the
@@ -27,8 +47,483 @@ class ThirdPartyYouTubeService(YouTubeServiceBaseClass):
         return f'Detailed information about a video №{id}.'
 
     def download_video(self, id):
+        return b''.join(self.stream_video(id))
+
+    def stream_video(self, id, chunk_size=64 * 1024):
         print('Waiting for the service to process the download request...')
-        return f'Video №{id} from Youtube.'
+        video = f'Video №{id} from Youtube.'.encode()
+        for start in range(0, len(video), chunk_size):
+            yield video[start:start + chunk_size]
+
+
+# The cache used by Proxy. Entries are kept in the order of their use, so when the cache runs out of entries or
+# bytes, the least recently used entries are the first to leave. Besides, each entry lives no longer than its TTL.
+class LRUCache:
+    # on_evict(key, reason) is called for every entry that leaves the cache other than by being overwritten.
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, sizeof=sys.getsizeof, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__sizeof = sizeof
+        self.__on_evict = on_evict
+        # key -> (value, size in bytes, moment of storing, expiration moment or None)
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def size_in_bytes(self):
+        return self.__bytes
+
+    def get(self, key, default=None):
+        return self.get_entry(key, default)[0]
+
+    # Returns the value together with the moment it was stored, or (default, None) if there is no valid entry.
+    def get_entry(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default, None
+            if entry[3] is not None and entry[3] <= time.monotonic():
+                self.__remove(key, 'expired')
+                return default, None
+            self.__entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def set(self, key, value, ttl=None):
+        size = self.__sizeof(value)
+        stored_at = time.monotonic()
+        expires_at = None if ttl is None else stored_at + ttl
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            # A value that alone exceeds the limit would just push everything else out, so it is not cached at all.
+            if size > self.max_bytes:
+                if self.__on_evict is not None:
+                    self.__on_evict(key, 'too_large')
+                return
+            self.__entries[key] = (value, size, stored_at, expires_at)
+            self.__bytes += size
+            while len(self.__entries) > self.max_entries:
+                self.__remove(next(iter(self.__entries)), 'entries')
+            while self.__bytes > self.max_bytes:
+                self.__remove(next(iter(self.__entries)), 'bytes')
+
+    def invalidate(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            self.__remove(key, 'invalidated')
+            return True
+
+    def clear(self):
+        with self.__lock:
+            for key in list(self.__entries):
+                self.__remove(key, 'cleared')
+
+    def __remove(self, key, reason=None):
+        self.__bytes -= self.__entries.pop(key)[1]
+        if reason is not None and self.__on_evict is not None:
+            self.__on_evict(key, reason)
+
+
+# Yields memoryview slices of bytes [start, end) of a view. A mapping is released when the last of the slices handed
+# out is garbage collected.
+def _view_chunks(view, start, end, chunk_size):
+    for position in range(start, end, chunk_size):
+        yield view[position:min(position + chunk_size, end)]
+
+
+# Content-addressed disk cache for downloaded videos. Each video is written once to a file named after the SHA-256 of
+# its content, and an index maps cache keys to these digests, so equal videos share a file. Files are read through
+# mmap: the chunks handed out are memoryview slices of the mapping, so the bytes are never copied to the heap.
+class DiskContentCache:
+    # on_evict(key, reason) is called like in LRUCache; for evicted files the key is their digest.
+    def __init__(self, directory=None, max_bytes=10 * 1024 ** 3, on_evict=None):
+        self.on_evict = on_evict
+        # Without a directory, a temporary one is used, and it is removed together with the cache.
+        self.__temporary_directory = None
+        if directory is None:
+            self.__temporary_directory = tempfile.TemporaryDirectory(prefix='youtube-proxy-')
+            directory = self.__temporary_directory.name
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        # key -> (digest, expiration moment or None)
+        self.__index = {}
+        # digest -> size in bytes, in the order of use.
+        self.__files = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.__digest(key) is not None
+
+    def __len__(self):
+        return len(self.__files)
+
+    def size_in_bytes(self):
+        return self.__bytes
+
+    # Returns a view of the stored content. It is mapped before anything can evict it, so it can be read even when
+    # the entry expires or is evicted right away. With a PartialContent, readers can follow the content while it is
+    # being written.
+    def put(self, key, chunks, ttl=None, partial=None):
+        digest = hashlib.sha256()
+        size = 0
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                if partial is not None:
+                    partial.started(temporary_path)
+                for chunk in chunks:
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+                    if partial is not None:
+                        file.flush()
+                        partial.written(size)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        digest = digest.hexdigest()
+        # The file is put in place and recorded under the lock, so an eviction of the same digest cannot unlink it in
+        # between.
+        with self.__lock:
+            try:
+                os.replace(temporary_path, self.__path(digest))
+            except BaseException:
+                os.unlink(temporary_path)
+                raise
+            if digest not in self.__files:
+                self.__files[digest] = size
+                self.__bytes += size
+            self.__files.move_to_end(digest)
+            try:
+                view = self.__map(digest, size)
+            except BaseException:
+                # Keys that still refer to the digest find it gone and are dropped when they are looked up.
+                self.__bytes -= self.__files.pop(digest)
+                if os.path.exists(self.__path(digest)):
+                    os.unlink(self.__path(digest))
+                raise
+            self.__index[key] = (digest, None if ttl is None else time.monotonic() + ttl)
+            while self.__bytes > self.max_bytes and len(self.__files) > 1:
+                self.__remove_file(next(iter(self.__files)), 'bytes')
+        return view
+
+    # Returns a generator of memoryview chunks covering bytes [start, end) of the cached content, or None if the key
+    # is not cached. The file is mapped right away, so a concurrent eviction cannot pull it from under the reader.
+    def read(self, key, start=0, end=None, chunk_size=64 * 1024):
+        with self.__lock:
+            digest = self.__digest(key)
+            if digest is None:
+                return None
+            size = self.__files[digest]
+            view = self.__map(digest, size)
+        start, end, _ = slice(start, end).indices(size)
+        return _view_chunks(view, start, end, chunk_size)
+
+    def invalidate(self, key):
+        with self.__lock:
+            if self.__index.pop(key, None) is None:
+                return False
+            self.__evicted(key, 'invalidated')
+            return True
+
+    def clear(self):
+        with self.__lock:
+            self.__index.clear()
+            for digest in list(self.__files):
+                self.__remove_file(digest, 'cleared')
+
+    # Must be called with the lock held.
+    def __digest(self, key):
+        entry = self.__index.get(key)
+        if entry is None:
+            return None
+        digest, expires_at = entry
+        if digest not in self.__files or expires_at is not None and expires_at <= time.monotonic():
+            del self.__index[key]
+            if digest in self.__files:
+                self.__evicted(key, 'expired')
+            return None
+        self.__files.move_to_end(digest)
+        return digest
+
+    def __remove_file(self, digest, reason):
+        self.__bytes -= self.__files.pop(digest)
+        # The mappings that are still being read stay valid after the file is unlinked.
+        os.unlink(self.__path(digest))
+        self.__evicted(digest, reason)
+
+    def __evicted(self, key, reason):
+        if self.on_evict is not None:
+            self.on_evict(key, reason)
+
+    def __path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    # Must be called with the lock held.
+    def __map(self, digest, size):
+        if not size:
+            return memoryview(b'')
+        with open(self.__path(digest), 'rb') as file:
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# Content that DiskContentCache.put is writing on another thread. Readers follow the temporary file as it grows, so
+# the first chunks reach them while the rest is still being downloaded; once the content is stored, they go on with
+# its mapping.
+class PartialContent:
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__path = None
+        self.__size = 0
+        self.__done = False
+        self.__view = None
+        self.__error = None
+
+    def started(self, path):
+        with self.__condition:
+            self.__path = path
+
+    def written(self, size):
+        with self.__condition:
+            self.__size = size
+            self.__condition.notify_all()
+
+    def finish(self, view=None, error=None):
+        with self.__condition:
+            self.__done = True
+            self.__view, self.__error = view, error
+            self.__condition.notify_all()
+
+    # Yields chunks of bytes [start, end) of the content, like DiskContentCache.read, but without waiting for whole
+    # chunks while the content is being written. Positions counted from the end are only known once it is complete.
+    def read(self, start=0, end=None, chunk_size=64 * 1024):
+        if start < 0 or end is not None and end < 0:
+            view = self.__wait()
+            start, end, _ = slice(start, end).indices(len(view))
+            yield from _view_chunks(view, start, end, chunk_size)
+            return
+        position, file = start, None
+        try:
+            while end is None or position < end:
+                with self.__condition:
+                    wanted = position + chunk_size if end is None else min(position + chunk_size, end)
+                    while not self.__done and self.__size <= position:
+                        self.__condition.wait()
+                    if self.__done:
+                        break
+                    available, path = self.__size, self.__path
+                if file is None:
+                    try:
+                        file = open(path, 'rb')
+                    except FileNotFoundError:
+                        # The content has just been stored under its digest.
+                        self.__wait()
+                        continue
+                data = os.pread(file.fileno(), min(available, wanted) - position, position)
+                position += len(data)
+                yield data
+        finally:
+            if file is not None:
+                file.close()
+        view = self.__wait()
+        size = len(view) if end is None else min(end, len(view))
+        yield from _view_chunks(view, position, size, chunk_size)
+
+    def __wait(self):
+        with self.__condition:
+            while not self.__done:
+                self.__condition.wait()
+            if self.__error is not None:
+                raise self.__error
+            return self.__view
+
+
+# Histogram of durations in seconds with fixed bucket bounds. Recording a value costs a binary search and an
+# increment, so it can be done on every request.
+class LatencyHistogram:
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        # The last bucket collects everything above the largest bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    # Upper bound of the bucket holding the q-th quantile, e.g. quantile(0.99) for p99.
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(self.bounds + (float('inf'),), self.counts)),
+        }
+
+
+# Metrics collected by Proxy: cache hits and misses per method, latency and errors of the requests that reach
+# Service, the number of such requests in flight, evictions by reason and the sizes of the caches. snapshot() returns
+# all of them as a plain dict. If export_hook is given, it receives a snapshot at most every export_interval seconds,
+# checked whenever something is recorded, or whenever export() is called.
+class ProxyMetrics:
+    def __init__(self, export_hook=None, export_interval=60):
+        self.__lock = threading.Lock()
+        self.__hits = Counter()
+        self.__stale_hits = Counter()
+        self.__misses = Counter()
+        self.__errors = Counter()
+        self.__in_flight = Counter()
+        self.__latencies = {}
+        self.__evictions = Counter()
+        # name -> function returning (entries, bytes)
+        self.__sizes = {}
+        self.export_hook = export_hook
+        self.export_interval = export_interval
+        self.__next_export = time.monotonic() + export_interval
+
+    def track_size(self, name, function):
+        self.__sizes[name] = function
+
+    def record_hit(self, method, stale=False):
+        with self.__lock:
+            self.__hits[method] += 1
+            if stale:
+                self.__stale_hits[method] += 1
+        self.__maybe_export()
+
+    def record_miss(self, method):
+        with self.__lock:
+            self.__misses[method] += 1
+        self.__maybe_export()
+
+    def record_eviction(self, reason):
+        with self.__lock:
+            self.__evictions[reason] += 1
+
+    # Wraps a request to Service: with metrics.upstream_call('get_video_info'): ...
+    @contextmanager
+    def upstream_call(self, method):
+        with self.__lock:
+            self.__in_flight[method] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self.__lock:
+                self.__errors[method] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.__lock:
+                self.__in_flight[method] -= 1
+                self.__latencies.setdefault(method, LatencyHistogram()).observe(elapsed)
+
+    def snapshot(self):
+        with self.__lock:
+            methods = {}
+            for method in set(self.__hits) | set(self.__misses) | set(self.__latencies):
+                hits, misses = self.__hits[method], self.__misses[method]
+                latency = self.__latencies.get(method)
+                methods[method] = {
+                    'hits': hits,
+                    'stale_hits': self.__stale_hits[method],
+                    'misses': misses,
+                    'hit_ratio': hits / (hits + misses) if hits + misses else None,
+                    'upstream_errors': self.__errors[method],
+                    'upstream_in_flight': self.__in_flight[method],
+                    'upstream_latency': latency.snapshot() if latency is not None else None,
+                }
+            evictions = dict(self.__evictions)
+        sizes = {}
+        for name, function in self.__sizes.items():
+            entries, size_in_bytes = function()
+            sizes[name] = {'entries': entries, 'bytes': size_in_bytes}
+        return {'methods': methods, 'evictions': evictions, 'caches': sizes}
+
+    def export(self):
+        with self.__lock:
+            self.__next_export = time.monotonic() + self.export_interval
+        self.__export()
+
+    # Runs on every request, so unless an export is due it only reads the clock. A due export is claimed under the
+    # lock by exactly one request, and it runs on a thread of its own, so no request waits for the hook.
+    def __maybe_export(self):
+        if self.export_hook is None or time.monotonic() < self.__next_export:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            if now < self.__next_export:
+                return
+            self.__next_export = now + self.export_interval
+        threading.Thread(target=self.__export, name='proxy-metrics-export', daemon=True).start()
+
+    def __export(self):
+        export_hook = self.export_hook
+        if export_hook is not None:
+            export_hook(self.snapshot())
+
+
+# Single flight lets only one call per key reach the slow Service at a time. Everyone who asks for the same key while
+# that call is running waits for it and receives the same result, or the same exception.
+class SingleFlight:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+    def do(self, key, function, *args):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            call.set_result(function(*args))
+        except BaseException as error:
+            call.set_exception(error)
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+        return call.result()
+
+
+# The same for coroutines. The shared call runs as a separate task, so cancelling one of the waiters does not cancel
+# the request the others are waiting for.
+class AsyncSingleFlight:
+    def __init__(self):
+        self.__calls = {}
+
+    async def do(self, key, function, *args):
+        call = self.__calls.get(key)
+        if call is None:
+            call = self.__calls[key] = asyncio.ensure_future(function(*args))
+            call.add_done_callback(lambda _: self.__calls.pop(key, None))
+        return await asyncio.shield(call)
 
 
 # On the other hand, you can cache requests to YouTube and not repeat them for a while until the cache is out of
@@ -36,31 +531,164 @@ class ThirdPartyYouTubeService(YouTubeServiceBaseClass):
 # we will put the caching logic in a separate wrapper class. It will delegate requests to Service object only if
 # it needs to send a request directly.
 class YouTubeProxy(YouTubeServiceBaseClass):
-    def __init__(self, service):
+    # How many seconds the answers of each Service method stay valid. None means until eviction or reset.
+    default_ttls = {
+        'get_video_list': 60,
+        'get_video_info': 300,
+        'download_video': 3600,
+    }
+    # Stale-while-revalidate: after this many seconds the answer is still returned immediately, but it is refreshed
+    # in the background. Callers are blocked only when the answer is older than its (hard) TTL above.
+    default_soft_ttls = {
+        'get_video_list': 30,
+    }
+
+    def __init__(self, service, max_entries=1024, max_bytes=64 * 1024 * 1024, ttls=None, coalesce=True,
+                 soft_ttls=None, refresh_workers=1, disk_cache=None, metrics=None):
         self.__service = service
-        self.__video_list_cache = None
-        self.__video_cache = None
-        self.__download_cache = None
+        self.__ttls = dict(self.default_ttls, **(ttls or {}))
+        self.__soft_ttls = dict(self.default_soft_ttls, **(soft_ttls or {}))
+        self.metrics = metrics if metrics is not None else ProxyMetrics()
+        # Answers are cached under the key (method name, *arguments), so every video id gets its own entry.
+        self.__cache = LRUCache(max_entries, max_bytes, on_evict=self.__evicted)
+        # Videos are too big for memory, so they are kept on disk.
+        self.__disk_cache = disk_cache if disk_cache is not None else DiskContentCache()
+        self.__disk_cache.on_evict = self.__evicted
+        self.metrics.track_size('memory', lambda: (len(self.__cache), self.__cache.size_in_bytes()))
+        self.metrics.track_size('disk', lambda: (len(self.__disk_cache), self.__disk_cache.size_in_bytes()))
+        # With coalescing, concurrent misses on the same key cost a single request to Service.
+        self.__flights = SingleFlight() if coalesce else None
+        # key -> PartialContent of the videos being downloaded, for coalescing.
+        self.__downloads = {}
+        self.__downloads_lock = threading.Lock()
+        self.__refresh_workers = refresh_workers
+        self.__refresh_executor = None
+        self.__refreshing = set()
+        self.__refresh_lock = threading.Lock()
+        # Answers stored before this moment are stale regardless of their age, see reset(soft=True).
+        self.__stale_before = float('-inf')
 
     def get_video_list(self):
-        if not self.__video_list_cache:
-            self.__video_list_cache = self.__service.get_video_list()
-        return self.__video_list_cache
+        return self.__cached('get_video_list')
 
     def get_video_info(self, id):
-        if not self.__video_cache:
-            self.__video_cache = self.__service.get_video_info(id)
-        return self.__video_cache
+        return self.__cached('get_video_info', id)
 
     def download_video(self, id):
-        if not self.__download_cache:
-            self.__download_cache = self.__service.download_vieo()
-        return self.__download_cache
+        return b''.join(self.stream_video(id))
 
-    def reset(self):
-        self.__video_list_cache = None
-        self.__video_cache = None
-        self.__download_cache = None
+    # Yields chunks of bytes [start, end) of the video. The video is downloaded to the disk cache on the first
+    # request, in the background: the first chunks are yielded as soon as they arrive, and concurrent requests for the
+    # same video follow the same download. Every following full or partial download is served from the disk cache.
+    def stream_video(self, id, chunk_size=64 * 1024, start=0, end=None):
+        key = ('download_video', id)
+        chunks = self.__disk_cache.read(key, start, end, chunk_size)
+        if chunks is not None:
+            self.metrics.record_hit('download_video')
+            return chunks
+        self.metrics.record_miss('download_video')
+        return self.__download(key, id).read(start, end, chunk_size)
+
+    # Drop a single cached answer, e.g. proxy.invalidate('get_video_info', 5).
+    def invalidate(self, method, *args):
+        key = (method,) + args
+        if method == 'download_video':
+            return self.__disk_cache.invalidate(key)
+        return self.__cache.invalidate(key)
+
+    # A soft reset does not drop anything: the cached answers are only marked stale, so they keep being served
+    # while fresh ones are fetched in the background. Downloaded videos are kept by a soft reset.
+    def reset(self, soft=False):
+        if soft:
+            self.__stale_before = time.monotonic()
+        else:
+            self.__cache.clear()
+            self.__disk_cache.clear()
+
+    def __cached(self, method, *args):
+        key = (method,) + args
+        value, stored_at = self.__cache.get_entry(key, _MISSING)
+        if value is not _MISSING:
+            stale = self.__is_stale(method, stored_at)
+            if stale:
+                self.__refresh_in_background(key, method, args)
+            self.metrics.record_hit(method, stale)
+            return value
+        self.metrics.record_miss(method)
+        return self.__single_flight(key, self.__load, key, method, args)
+
+    def __is_stale(self, method, stored_at):
+        if stored_at <= self.__stale_before:
+            return True
+        soft_ttl = self.__soft_ttls.get(method)
+        return soft_ttl is not None and time.monotonic() - stored_at >= soft_ttl
+
+    def __single_flight(self, key, function, *args):
+        if self.__flights is None:
+            return function(*args)
+        return self.__flights.do(key, function, *args)
+
+    def __load(self, key, method, args):
+        # The previous flight may have filled the cache right before this one started.
+        value = self.__cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.__fetch(key, method, args)
+        return value
+
+    def __fetch(self, key, method, args):
+        with self.metrics.upstream_call(method):
+            value = getattr(self.__service, method)(*args)
+        self.__cache.set(key, value, self.__ttls[method])
+        return value
+
+    # Returns the PartialContent of the video, starting its download unless it is already in progress.
+    def __download(self, key, id):
+        with self.__downloads_lock:
+            partial = self.__downloads.get(key)
+            if partial is not None:
+                return partial
+            partial = PartialContent()
+            if self.__flights is not None:
+                self.__downloads[key] = partial
+        threading.Thread(target=self.__run_download, args=(key, id, partial), name='youtube-proxy-download',
+                         daemon=True).start()
+        return partial
+
+    def __run_download(self, key, id, partial):
+        try:
+            with self.metrics.upstream_call('download_video'):
+                view = self.__disk_cache.put(key, self.__service.stream_video(id), self.__ttls['download_video'],
+                                             partial)
+        except BaseException as error:
+            partial.finish(error=error)
+        else:
+            partial.finish(view)
+        finally:
+            with self.__downloads_lock:
+                if self.__downloads.get(key) is partial:
+                    del self.__downloads[key]
+
+    def __evicted(self, key, reason):
+        self.metrics.record_eviction(reason)
+
+    def __refresh_in_background(self, key, method, args):
+        with self.__refresh_lock:
+            if key in self.__refreshing:
+                return
+            self.__refreshing.add(key)
+            if self.__refresh_executor is None:
+                self.__refresh_executor = ThreadPoolExecutor(self.__refresh_workers, 'youtube-proxy-refresh')
+            self.__refresh_executor.submit(self.__refresh, key, method, args)
+
+    def __refresh(self, key, method, args):
+        try:
+            self.__single_flight(key, self.__fetch, key, method, args)
+        except Exception:
+            # The stale answer stays in the cache, so the next stale hit simply tries again.
+            pass
+        finally:
+            with self.__refresh_lock:
+                self.__refreshing.discard(key)
 
 
 # The GUI class that uses Service object. Instead of a real Service, we'll slip Proxy object into it. The
@@ -84,6 +712,168 @@ class YouTubeManager:
         return self.render_list_panel() + '\n' + self.render_video_page(id)
 
 
+# Asynchronous Service interface. Its methods are coroutines, so a single client can keep many requests in flight.
+# get_video_info_many returns the details of several videos, in the order of their ids, for a single round-trip.
+class AsyncYouTubeServiceBaseClass:
+    async def get_video_list(self):
+        raise NotImplementedError("Method is not implemented!")
+
+    async def get_video_info(self, id):
+        raise NotImplementedError("Method is not implemented!")
+
+    async def get_video_info_many(self, ids):
+        raise NotImplementedError("Method is not implemented!")
+
+    async def download_video(self, id):
+        raise NotImplementedError("Method is not implemented!")
+
+
+# The asynchronous flavor of the third-party Service. Waiting for the network is simulated with a delay.
+class AsyncThirdPartyYouTubeService(AsyncYouTubeServiceBaseClass):
+    def __init__(self, latency=0.1):
+        self.latency = latency
+
+    async def get_video_list(self):
+        print('Waiting for the service to process the video list request...')
+        await asyncio.sleep(self.latency)
+        return 'List of YouTube videos.'
+
+    async def get_video_info(self, id):
+        print('Waiting for the service to process the video info request...')
+        await asyncio.sleep(self.latency)
+        return f'Detailed information about a video №{id}.'
+
+    async def get_video_info_many(self, ids):
+        print(f'Waiting for the service to process the video info request for {len(ids)} videos...')
+        await asyncio.sleep(self.latency)
+        return [f'Detailed information about a video №{id}.' for id in ids]
+
+    async def download_video(self, id):
+        print('Waiting for the service to process the download request...')
+        await asyncio.sleep(self.latency)
+        return f'Video №{id} from Youtube.'.encode()
+
+
+# The asynchronous Proxy caches answers the same way as YouTubeProxy and coalesces concurrent misses. In addition,
+# it collects the video info requests that arrive within one batch window and sends them to Service as a single
+# get_video_info_many call.
+class AsyncYouTubeProxy(AsyncYouTubeServiceBaseClass):
+    def __init__(self, service, max_entries=1024, max_bytes=64 * 1024 * 1024, ttls=None, batch_window=0.005,
+                 max_batch_size=100):
+        self.__service = service
+        self.__ttls = dict(YouTubeProxy.default_ttls, **(ttls or {}))
+        self.__cache = LRUCache(max_entries, max_bytes)
+        self.__flights = AsyncSingleFlight()
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        # id -> future of its info, for the batch that is being collected now.
+        self.__batch = {}
+        self.__batch_timer = None
+        self.__batch_tasks = set()
+
+    async def get_video_list(self):
+        return await self.__cached(('get_video_list',), self.__service.get_video_list)
+
+    async def get_video_info(self, id):
+        return await self.__cached(('get_video_info', id), self.__batched_video_info, id)
+
+    async def get_video_info_many(self, ids):
+        return list(await asyncio.gather(*(self.get_video_info(id) for id in ids)))
+
+    async def download_video(self, id):
+        return await self.__cached(('download_video', id), self.__service.download_video, id)
+
+    def invalidate(self, method, *args):
+        return self.__cache.invalidate((method,) + args)
+
+    def reset(self):
+        self.__cache.clear()
+
+    async def __cached(self, key, function, *args):
+        value = self.__cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return await self.__flights.do(key, self.__load, key, function, args)
+
+    async def __load(self, key, function, args):
+        value = self.__cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = await function(*args)
+            self.__cache.set(key, value, self.__ttls[key[0]])
+        return value
+
+    def __batched_video_info(self, id):
+        future = self.__batch.get(id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.__batch[id] = loop.create_future()
+            if len(self.__batch) >= self.max_batch_size:
+                self.__send_batch()
+            elif self.__batch_timer is None:
+                self.__batch_timer = loop.call_later(self.batch_window, self.__send_batch)
+        return future
+
+    def __send_batch(self):
+        if self.__batch_timer is not None:
+            self.__batch_timer.cancel()
+            self.__batch_timer = None
+        batch, self.__batch = self.__batch, {}
+        task = asyncio.ensure_future(self.__fetch_batch(batch))
+        # The loop keeps only weak references to tasks, so they are held here until they are finished.
+        self.__batch_tasks.add(task)
+        task.add_done_callback(self.__batch_tasks.discard)
+
+    # If the batch request fails, or does not return an info for every id, each id is asked for on its own, so one
+    # bad id does not fail the requests of everybody else in the window.
+    async def __fetch_batch(self, batch):
+        try:
+            try:
+                infos = await self.__service.get_video_info_many(list(batch))
+                if len(infos) != len(batch):
+                    raise ValueError(f'{len(infos)} video infos were returned for {len(batch)} ids')
+            except Exception as error:
+                if len(batch) == 1:
+                    infos = [error]
+                else:
+                    infos = await asyncio.gather(*(self.__service.get_video_info(id) for id in batch),
+                                                 return_exceptions=True)
+            for future, info in zip(batch.values(), infos):
+                if future.done():
+                    continue
+                if isinstance(info, BaseException):
+                    future.set_exception(info)
+                else:
+                    future.set_result(info)
+        finally:
+            # Cancelling the batch must not leave its waiters hanging.
+            for future in batch.values():
+                if not future.done():
+                    future.cancel()
+
+
+# The asynchronous GUI class. The list panel and the video page are requested at the same time, so rendering takes
+# as long as the slowest request rather than the sum of all of them.
+class AsyncYouTubeManager:
+    def __init__(self, service):
+        self.__service = service
+
+    async def render_video_page(self, id):
+        return await self.__service.get_video_info(id)
+
+    async def render_video_pages(self, ids):
+        return await self.__service.get_video_info_many(ids)
+
+    async def render_list_panel(self):
+        return await self.__service.get_video_list()
+
+    def reset(self):
+        self.__service.reset()
+
+    async def react_on_user_input(self, id):
+        panel, page = await asyncio.gather(self.render_list_panel(), self.render_video_page(id))
+        return panel + '\n' + page
+
+
 if __name__ == '__main__':
     youtube_service = ThirdPartyYouTubeService()
     youtube_proxy = YouTubeProxy(youtube_service)
@@ -95,6 +885,56 @@ if __name__ == '__main__':
     print('Cached request:')
     print(youtube_manager.react_on_user_input(5) + '\n')
 
+    print('Request for another video:')
+    print(youtube_manager.react_on_user_input(6) + '\n')
+
+    print('Request after invalidating a single video:')
+    youtube_proxy.invalidate('get_video_info', 5)
+    print(youtube_manager.react_on_user_input(5) + '\n')
+
+    print('Concurrent requests for the same video:')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        print(set(pool.map(youtube_proxy.get_video_info, [7] * 8)), '\n')
+
+    print('Concurrent coroutines for the same video:')
+    flights = AsyncSingleFlight()
+
+    async def fetch_concurrently():
+        requests = [flights.do(8, asyncio.to_thread, youtube_service.get_video_info, 8) for _ in range(8)]
+        return set(await asyncio.gather(*requests))
+
+    print(asyncio.run(fetch_concurrently()), '\n')
+
+    print('Downloading a video in chunks, then a part of it from the disk cache:')
+    print([bytes(chunk) for chunk in youtube_proxy.stream_video(5, chunk_size=8)])
+    print(b''.join(youtube_proxy.stream_video(5, start=6)).decode() + '\n')
+
+    print('Request after soft reset (the stale list is served while it is refreshed in the background):')
+    youtube_proxy.reset(soft=True)
+    print(youtube_manager.render_list_panel() + '\n')
+    time.sleep(0.1)
+
     print('Request after reset:')
     youtube_manager.reset()
     print(youtube_manager.react_on_user_input(5) + '\n')
+
+    print('Cache metrics (hit ratios and evictions):')
+    youtube_proxy.metrics.export_hook = lambda snapshot: print(
+        {method: round(stats['hit_ratio'], 2) for method, stats in snapshot['methods'].items()},
+        snapshot['evictions'],
+    )
+    youtube_proxy.metrics.export()
+    print()
+
+    async_youtube_manager = AsyncYouTubeManager(AsyncYouTubeProxy(AsyncThirdPartyYouTubeService()))
+
+    async def render_pages():
+        # Five users open different pages at once: one list request and one batched info request reach Service.
+        pages = await asyncio.gather(*(async_youtube_manager.react_on_user_input(id) for id in range(1, 6)))
+        print('\n\n'.join(pages) + '\n')
+
+        print('Cached batch request:')
+        print(await async_youtube_manager.render_video_pages([1, 3, 9]))
+
+    print('Concurrent asynchronous requests:')
+    asyncio.run(render_pages())